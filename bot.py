@@ -1,40 +1,27 @@
 import asyncio
-import os
 from typing import List, Tuple, Dict, Any, Optional
 from telethon import TelegramClient, events
 from telethon.sessions import StringSession
 from telethon.errors import SessionPasswordNeededError
-from src.crypto import encrypt_str, decrypt_str
-from src.models import SessionLocal, Base, engine, User, Account, Job, EventLog, GroupStat
+from src.crypto import encrypt_str, decrypt_str, api_credentials
+from src.models import SessionLocal, get_engine, read_session, mark_owner_write, READ_YOUR_WRITES, User, Account, Job, EventLog, GroupStat
 from sqlalchemy import select
-from src.utils import logger, now_utc, parse_admin_ids
-from src.kpi import my_stats
+from src.utils import logger, now_utc, parse_admin_ids, configure_logging
+from src.kpi import cached_my_stats, invalidate_stats
+from src.digest import digest_loop
+from src.migrations import run_migrations
+from src.accounts import disable_account, enable_account, delete_account
+from src.config import get_settings, install_reload_handler
 from telethon import functions
-from dotenv import load_dotenv
 
-load_dotenv()
-
-api_id_str = os.getenv("API_ID")
-api_hash = os.getenv("API_HASH")
-
-if not api_id_str or not api_hash:
-    raise RuntimeError("API_ID and API_HASH must be set in the environment (e.g. in .env)")
-
-try:
-    api_id = int(api_id_str)
-except ValueError:
-    raise RuntimeError("API_ID must be an integer")
-
-# bot token is read at runtime to avoid import-time KeyError
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+# credentials and tunables come from src.config.get_settings() at runtime
 
 # state machine (very small, per-user)
 user_states: Dict[int, Dict[str, Any]] = {}  # {user_id: {"stage": str, "tmp": dict}}
 
 async def init_db():
     try:
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+        await run_migrations(get_engine())
         logger.info("db.init.success")
     except Exception as e:
         logger.exception("db.init.error", error=str(e))
@@ -48,6 +35,11 @@ def kb(rows: List[List[Tuple[str, str]]]):
     from telethon import Button
     return [[Button.inline(text, data=data.encode()) for (text,data) in row] for row in rows]
 
+def owner_changed(uid: int) -> None:
+    # route this owner's next reads to the primary and drop their cached stats
+    mark_owner_write(uid)
+    invalidate_stats(uid)
+
 async def start(ev: events.NewMessage.Event):
     uid = ev.sender_id
     logger.info("handler.start", user_id=uid)
@@ -55,6 +47,7 @@ async def start(ev: events.NewMessage.Event):
         if not await s.get(User, uid):
             s.add(User(id=uid))
             await s.commit()
+            owner_changed(uid)
     text = (
         "سلام! من ربات مدیریت اکانت‌های Telethon هستم.\n"
         "از منو یکی را انتخاب کن:\n"
@@ -69,7 +62,7 @@ async def start(ev: events.NewMessage.Event):
 
 async def stats_cb(ev: events.CallbackQuery.Event):
     logger.info("handler.stats", user_id=ev.sender_id)
-    a, g, q, f, nxt = await my_stats(ev.sender_id)
+    a, g, q, f, nxt = await cached_my_stats(ev.sender_id)
     nxt_text = "نامشخص" if nxt is None else f"{nxt} دقیقه"
     await ev.edit(
         "آمار شما:\n"
@@ -84,7 +77,8 @@ async def add_account_cb(ev: events.CallbackQuery.Event):
     uid = ev.sender_id
     logger.info("handler.add_account.begin", user_id=uid)
     # اگر کاربر قبلاً اکانتی دارد، از همان api_id/api_hash ذخیره‌شده استفاده کن
-    async with SessionLocal() as s:
+    # an account added moments ago must be visible here
+    async with read_session(uid, READ_YOUR_WRITES) as s:
         res = await s.execute(select(Account).where(Account.owner_id==uid))
         first_acc = res.scalars().first()
     if first_acc:
@@ -243,6 +237,7 @@ async def generic_inbox(ev: events.NewMessage.Event):
                 logger.warning("first_group.create.error", user_id=uid, error=str(e))
             # schedule next job for later
             await schedule_next_for_account(s, account)
+        owner_changed(uid)
 
         await client.disconnect()
 
@@ -308,6 +303,7 @@ async def generic_inbox(ev: events.NewMessage.Event):
             except Exception as e:
                 logger.warning("first_group.create.error", user_id=uid, error=str(e))
             await schedule_next_for_account(s, account)
+        owner_changed(uid)
 
         await client.disconnect()
 
@@ -322,7 +318,8 @@ async def generic_inbox(ev: events.NewMessage.Event):
 async def sessions_menu(ev: events.CallbackQuery.Event):
     uid = ev.sender_id
     logger.info("handler.sessions_menu", user_id=uid)
-    async with SessionLocal() as s:
+    # reflect enable/disable/delete the user just did
+    async with read_session(uid, READ_YOUR_WRITES) as s:
         res = await s.execute(select(Account).where(Account.owner_id==uid))
         accounts = res.scalars().all()
     if not accounts:
@@ -349,31 +346,24 @@ async def acc_disable(ev: events.CallbackQuery.Event):
     aid = int(ev.data.decode().split("_")[2])
     logger.info("handler.acc_disable", account_id=aid, user_id=ev.sender_id)
     async with SessionLocal() as s:
-        a = await s.get(Account, aid)
-        if a:
-            a.is_active = False
-            await s.commit()
+        await disable_account(s, aid, owner_id=ev.sender_id)
+    owner_changed(ev.sender_id)
     await ev.answer("اکانت غیرفعال شد.")
 
 async def acc_enable(ev: events.CallbackQuery.Event):
     aid = int(ev.data.decode().split("_")[2])
     logger.info("handler.acc_enable", account_id=aid, user_id=ev.sender_id)
     async with SessionLocal() as s:
-        a = await s.get(Account, aid)
-        if a:
-            a.is_active = True
-            a.total_floodwait_s_24h = 0
-            await s.commit()
+        await enable_account(s, aid, owner_id=ev.sender_id)
+    owner_changed(ev.sender_id)
     await ev.answer("اکانت فعال شد.")
 
 async def acc_delete(ev: events.CallbackQuery.Event):
     aid = int(ev.data.decode().split("_")[2])
     logger.info("handler.acc_delete", account_id=aid, user_id=ev.sender_id)
     async with SessionLocal() as s:
-        a = await s.get(Account, aid)
-        if a:
-            await s.delete(a)
-            await s.commit()
+        await delete_account(s, aid, owner_id=ev.sender_id)
+    owner_changed(ev.sender_id)
     await ev.answer("اکانت حذف شد.")
 
 async def acc_enqueue(ev: events.CallbackQuery.Event):
@@ -382,15 +372,27 @@ async def acc_enqueue(ev: events.CallbackQuery.Event):
     logger.info("handler.acc_enqueue", account_id=aid, user_id=ev.sender_id)
     async with SessionLocal() as s:
         a = await s.get(Account, aid)
-        if not a:
+        if not a or a.owner_id != ev.sender_id:
             await ev.answer("اکانت یافت نشد.")
             return
-        await schedule_next_for_account(s, a)
+        queued = await schedule_next_for_account(s, a)
+    if not queued:
+        await ev.answer("اکانت غیرفعال است؛ ابتدا آن را فعال کنید.", alert=True)
+        return
+    owner_changed(ev.sender_id)
+    if a.circuit_state != "closed":
+        # the job waits for the next probe; enabling the account resets the breaker
+        await ev.answer(
+            "Job اضافه شد، اما اتصال این اکانت فعلاً قطع است و Job پس از بررسی مجدد اجرا می‌شود. "
+            "برای تلاش فوری، اکانت را دوباره فعال کنید.",
+            alert=True,
+        )
+        return
     await ev.answer("Job اضافه شد.")
 
 async def my_stats_cmd(ev: events.NewMessage.Event):
     logger.info("handler.my_stats", user_id=ev.sender_id)
-    a,g,q,f,nxt = await my_stats(ev.sender_id)
+    a,g,q,f,nxt = await cached_my_stats(ev.sender_id)
     nxt_text = "نامشخص" if nxt is None else f"{nxt} دقیقه"
     await ev.respond(
         "آمار شما:\n"
@@ -420,25 +422,43 @@ def register_handlers(c: TelegramClient) -> None:
     logger.info("handlers.registered")
 
 async def main():
+    configure_logging()
     try:
         await init_db()
         logger.info("bot.starting")
 
-        if not BOT_TOKEN:
+        bot_token = get_settings().bot_token
+        if not bot_token:
             raise RuntimeError("BOT_TOKEN not set in .env")
+        api_id, api_hash = api_credentials()
+        install_reload_handler()
 
         # create client with the running loop and then register handlers
         loop = asyncio.get_running_loop()
         c = TelegramClient("bot_session", api_id, api_hash, loop=loop)
-        await c.start(bot_token=BOT_TOKEN)
+        await c.start(bot_token=bot_token)
         global bot
         bot = c
         register_handlers(c)
 
+        async def _send_digest(owner_id: int, text: str) -> None:
+            await c.send_message(owner_id, text)
+        digest_stop = asyncio.Event()
+        # keep a reference: the loop only holds tasks weakly
+        digest_task = asyncio.create_task(digest_loop(_send_digest, digest_stop))
+
         info = await c.get_me()
         logger.info("bot.running", username=info.username)
 
-        await c.run_until_disconnected()
+        try:
+            await c.run_until_disconnected()
+        finally:
+            digest_stop.set()
+            try:
+                # an in-progress delivery may be sleeping out a FloodWait
+                await asyncio.wait_for(digest_task, timeout=5)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
         
     except Exception as e:
         logger.exception("bot.startup.error", error=str(e))
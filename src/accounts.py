@@ -0,0 +1,142 @@
+from __future__ import annotations
+from typing import Iterable, List, Optional
+from datetime import timedelta
+from sqlalchemy import select, update, delete, insert, exists, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import Account, Job
+from .utils import now_utc
+from .config import get_settings
+
+# Account lifecycle operations. Each one runs as a handful of set-based
+# UPDATE/DELETE statements so that no Account or Job rows are loaded into
+# the session, and queued work is cancelled/paused/resumed in the same
+# transaction as the account state change.
+
+PENDING_STATUSES = ("queued", "running", "paused")
+
+def _scoped(ids: Iterable[int], owner_id: Optional[int]):
+    cond = Account.id.in_(list(ids))
+    if owner_id is not None:
+        cond = and_(cond, Account.owner_id == owner_id)
+    return cond
+
+async def _owned_ids(session: AsyncSession, ids: Iterable[int], owner_id: Optional[int]) -> List[int]:
+    ids = list(ids)
+    if not ids:
+        return []
+    res = await session.execute(select(Account.id).where(_scoped(ids, owner_id)))
+    return [r for (r,) in res.all()]
+
+async def delete_accounts(session: AsyncSession, ids: Iterable[int], owner_id: Optional[int] = None) -> int:
+    """Delete accounts; jobs and group stats go with them via ON DELETE CASCADE."""
+    ids = list(ids)
+    if not ids:
+        return 0
+    res = await session.execute(
+        delete(Account).where(_scoped(ids, owner_id)).execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return res.rowcount or 0
+
+async def disable_accounts(session: AsyncSession, ids: Iterable[int], owner_id: Optional[int] = None) -> int:
+    """Deactivate accounts and cancel their queued/paused jobs."""
+    acc_ids = await _owned_ids(session, ids, owner_id)
+    if not acc_ids:
+        return 0
+    await session.execute(
+        update(Account).where(Account.id.in_(acc_ids)).values(is_active=False)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        update(Job)
+        .where(Job.account_id.in_(acc_ids), Job.status.in_(["queued", "paused"]))
+        .values(status="cancelled", error="account disabled")
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return len(acc_ids)
+
+async def pause_accounts(session: AsyncSession, ids: Iterable[int], owner_id: Optional[int] = None) -> int:
+    """Deactivate accounts but keep their queued jobs as `paused` so enable can resume them."""
+    acc_ids = await _owned_ids(session, ids, owner_id)
+    if not acc_ids:
+        return 0
+    await session.execute(
+        update(Account).where(Account.id.in_(acc_ids)).values(is_active=False)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        update(Job)
+        .where(Job.account_id.in_(acc_ids), Job.status == "queued")
+        .values(status="paused")
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return len(acc_ids)
+
+async def enable_accounts(session: AsyncSession, ids: Iterable[int], owner_id: Optional[int] = None) -> int:
+    """
+    Reactivate accounts: reset the floodwait counter and the circuit breaker,
+    resume paused jobs and schedule a fresh job for every account left
+    without pending work.
+    """
+    from .m_queue import _compute_delay_seconds
+    acc_ids = await _owned_ids(session, ids, owner_id)
+    if not acc_ids:
+        return 0
+    now = now_utc()
+    await session.execute(
+        update(Account).where(Account.id.in_(acc_ids)).values(
+            is_active=True, total_floodwait_s_24h=0,
+            circuit_state="closed", circuit_failures=0, circuit_open_until=None, circuit_error="",
+        )
+        .execution_options(synchronize_session=False)
+    )
+    # jobs held back by an open circuit run again right away
+    await session.execute(
+        update(Job)
+        .where(Job.account_id.in_(acc_ids), Job.status == "queued", Job.circuit_hold == True)
+        .values(next_run_at=now, circuit_hold=False)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        update(Job)
+        .where(Job.account_id.in_(acc_ids), Job.status == "paused")
+        .values(status="queued", next_run_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    res = await session.execute(
+        select(Account.id).where(
+            Account.id.in_(acc_ids),
+            ~exists().where(Job.account_id == Account.id, Job.status.in_(PENDING_STATUSES)),
+        )
+    )
+    idle = [r for (r,) in res.all()]
+    if idle:
+        await session.execute(insert(Job), [
+            dict(
+                account_id=aid,
+                type="CREATE_GROUP",
+                status="queued",
+                attempts=0,
+                max_attempts=get_settings().max_attempts_per_group,
+                payload="{}",
+                error="",
+                next_run_at=now + timedelta(seconds=_compute_delay_seconds()),
+            )
+            for aid in idle
+        ])
+    await session.commit()
+    return len(acc_ids)
+
+async def delete_account(session: AsyncSession, account_id: int, owner_id: Optional[int] = None) -> bool:
+    return await delete_accounts(session, [account_id], owner_id) > 0
+
+async def disable_account(session: AsyncSession, account_id: int, owner_id: Optional[int] = None) -> bool:
+    return await disable_accounts(session, [account_id], owner_id) > 0
+
+async def pause_account(session: AsyncSession, account_id: int, owner_id: Optional[int] = None) -> bool:
+    return await pause_accounts(session, [account_id], owner_id) > 0
+
+async def enable_account(session: AsyncSession, account_id: int, owner_id: Optional[int] = None) -> bool:
+    return await enable_accounts(session, [account_id], owner_id) > 0
@@ -0,0 +1,68 @@
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+import asyncio
+from .utils import monotonic
+
+class SingleFlightCache:
+    """
+    Per-key request coalescing with a short TTL.
+
+    Concurrent `get()` calls for the same key share one in-flight computation;
+    its result is then served from memory for `ttl_s` seconds. `invalidate()`
+    drops the cached value and detaches any in-flight computation so that
+    callers arriving after a change never receive a result computed before it.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._values: Dict[Hashable, Tuple[float, Any]] = {}  # key -> (expires_at, value)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._generation: Dict[Hashable, int] = {}
+
+    async def get(self, key: Hashable, compute: Callable[[], Awaitable[Any]], ttl_s: float) -> Any:
+        hit = self._values.get(key)
+        if hit is not None and hit[0] > monotonic():
+            return hit[1]
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            # shield: a cancelled follower must not cancel the shared computation
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        # followers that only see an exception must not trigger "never retrieved" warnings
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = fut
+        gen = self._generation.get(key, 0)
+        try:
+            value = await compute()
+        except BaseException as e:
+            if not fut.done():
+                if isinstance(e, asyncio.CancelledError):
+                    fut.cancel()
+                else:
+                    fut.set_exception(e)
+            raise
+        else:
+            if self._generation.get(key, 0) == gen and ttl_s > 0:
+                self._store(key, value, ttl_s)
+            if not fut.done():
+                fut.set_result(value)
+            return value
+        finally:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+    def _store(self, key: Hashable, value: Any, ttl_s: float) -> None:
+        now = monotonic()
+        if len(self._values) >= self.max_entries:
+            for k in [k for k, (exp, _) in self._values.items() if exp <= now]:
+                del self._values[k]
+            if len(self._values) >= self.max_entries:
+                self._values.pop(next(iter(self._values)))
+        self._values[key] = (now + ttl_s, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._values.pop(key, None)
+        self._inflight.pop(key, None)
+        self._generation[key] = self._generation.get(key, 0) + 1
@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import Optional
+from datetime import datetime, timedelta
+import asyncio
+from sqlalchemy import update, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from .config import get_settings
+from .models import Account, Job
+from .utils import now_utc, as_utc, jitter, logger
+
+# Per-account circuit breaker.
+#
+#   closed     normal operation
+#   open       the account's session looks dead; no job runs before
+#              `circuit_open_until` (its jobs are pushed back to that time)
+#   half_open  one job is probing the account; `circuit_open_until` is the
+#              probe's lease so a worker dying mid-probe does not wedge it
+#
+# Auth/unrecoverable errors (revoked or corrupted session, undecryptable
+# credentials at client init) open the circuit on the first failure.
+# Transient errors (network, Telegram 5xx) open it after
+# CIRCUIT_FAILURE_THRESHOLD in a row.
+# Every failed probe doubles the open period up to CIRCUIT_OPEN_MAX_SECONDS;
+# a success closes it.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+AUTH = "auth"
+TRANSIENT = "transient"
+
+def classify(exc: BaseException, client_init: bool = False) -> Optional[str]:
+    """
+    AUTH, TRANSIENT, or None for errors that say nothing about the account.
+    `client_init`: the error came from building the client (decrypt, session parse, connect).
+    """
+    from telethon.errors import UnauthorizedError, AuthKeyError, ServerError, TimedOutError
+    if isinstance(exc, (UnauthorizedError, AuthKeyError)):
+        return AUTH
+    # during init a ValueError means undecryptable credentials or a malformed
+    # api_id / StringSession; later it is just a bad request
+    if client_init and isinstance(exc, ValueError):
+        return AUTH
+    if isinstance(exc, (ServerError, TimedOutError, OSError, asyncio.TimeoutError)):
+        return TRANSIENT
+    return None
+
+def blocked_clause(now: datetime):
+    """SQL condition: true for accounts whose circuit currently blocks work."""
+    return and_(Account.circuit_state != CLOSED, Account.circuit_open_until > now)
+
+def not_before(account: Account) -> Optional[datetime]:
+    """Earliest time a new job for this account may run (None when closed)."""
+    if account.circuit_state == CLOSED or account.circuit_open_until is None:
+        return None
+    return as_utc(account.circuit_open_until)
+
+def _open_seconds(kind: str, failures: int) -> int:
+    cfg = get_settings()
+    if kind == AUTH:
+        base, n = cfg.circuit_auth_open_base_s, failures - 1
+    else:
+        base, n = cfg.circuit_open_base_s, failures - cfg.circuit_failure_threshold
+    delay = min(cfg.circuit_open_max_s, base * 2 ** max(0, min(n, 16)))
+    return int(delay) + jitter(int(delay * 0.1))
+
+async def admit(session: AsyncSession, job: Job, account: Account) -> bool:
+    """
+    Gate a leased job before any decrypt/connect. Returns False (and puts the
+    job back in the queue at the end of the open period) while the circuit is
+    open; once it has elapsed the first job through turns it half-open and
+    runs as the probe.
+    """
+    if account.circuit_state == CLOSED:
+        return True
+    now = now_utc()
+    until = not_before(account)
+    if until is None or until <= now:
+        # claim the probe; conditional so only one job per account probes.
+        # The job stops being held either way: it runs now or is re-held below.
+        job.circuit_hold = False
+        res = await session.execute(
+            update(Account)
+            .where(Account.id == account.id, Account.circuit_state != CLOSED,
+                   or_(Account.circuit_open_until.is_(None), Account.circuit_open_until <= now))
+            .values(circuit_state=HALF_OPEN, circuit_open_until=now + timedelta(seconds=get_settings().job_lease_s))
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        if res.rowcount:
+            await session.refresh(account)
+            logger.info("circuit.half_open", account_id=account.id, failures=account.circuit_failures)
+            return True
+        await session.refresh(account)
+        until = not_before(account) or now
+    job.status = "queued"
+    job.next_run_at = until
+    job.circuit_hold = True
+    await session.commit()
+    logger.info("circuit.skip", account_id=account.id, job_id=job.id, until=until.isoformat())
+    return False
+
+async def record_success(session: AsyncSession, account: Account) -> bool:
+    """Close the circuit; returns True if it was not closed before."""
+    if account.circuit_state == CLOSED and not account.circuit_failures:
+        return False
+    was_closed = account.circuit_state == CLOSED
+    account.circuit_state = CLOSED
+    account.circuit_failures = 0
+    account.circuit_open_until = None
+    account.circuit_error = ""
+    await session.commit()
+    if not was_closed:
+        logger.info("circuit.closed", account_id=account.id)
+    return not was_closed
+
+async def record_failure(session: AsyncSession, job: Job, account: Account, kind: str, error: str) -> Optional[datetime]:
+    """
+    Count a failure against the account. If the circuit (re)opens, the job and
+    every other queued job of the account are pushed to the end of the open
+    period and flagged `circuit_hold` (enable_accounts releases them) - the
+    job keeps its attempts, the account is at fault, not the job -
+    and the new `circuit_open_until` is returned. Returns None when the
+    failure stays below the threshold; the caller then handles the job as usual.
+    """
+    account.circuit_failures = (account.circuit_failures or 0) + 1
+    account.circuit_error = error[:500]
+    if kind == TRANSIENT and account.circuit_state == CLOSED \
+            and account.circuit_failures < get_settings().circuit_failure_threshold:
+        await session.commit()
+        return None
+    until = now_utc() + timedelta(seconds=_open_seconds(kind, account.circuit_failures))
+    account.circuit_state = OPEN
+    account.circuit_open_until = until
+    job.status = "queued"
+    job.next_run_at = until
+    job.circuit_hold = True
+    job.error = f"circuit open: {error}"[:500]
+    await session.execute(
+        update(Job)
+        .where(Job.account_id == account.id, Job.status == "queued", Job.id != job.id, Job.next_run_at < until)
+        .values(next_run_at=until, circuit_hold=True)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    logger.warning("circuit.open", account_id=account.id, kind=kind, failures=account.circuit_failures,
+                   until=until.isoformat(), error=error)
+    return until
@@ -0,0 +1,164 @@
+from __future__ import annotations
+from collections import deque
+from typing import Deque, Dict, List, Optional, Any
+import math
+from sqlalchemy.exc import OperationalError
+from .utils import logger, monotonic
+
+def is_lock_timeout(exc: BaseException) -> bool:
+    """SQLite 'database is locked' / Postgres lock timeouts surface as OperationalError."""
+    return isinstance(exc, OperationalError) and "lock" in str(exc).lower()
+
+def _p90(values: List[float]) -> Optional[float]:
+    if not values:
+        return None
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(math.ceil(0.9 * len(vals))) - 1)]
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of worker slots.
+
+    Every `interval_s` the observed window is evaluated:
+    - DB lock timeouts -> multiplicative decrease (congestion)
+    - FloodWaits / RPC attempts over `floodwait_rate_threshold` -> decrease
+      by one slot (FloodWait is a per-account limit, so only the rate says
+      anything about the pool as a whole)
+    - DB commit / RPC p90 latency over target -> decrease by one slot
+    - all slots busy with ready work left over -> additive increase
+    - otherwise the limit is held.
+    The limit always stays within [min_limit, max_limit].
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int = 1,
+        max_limit: int = 8,
+        db_latency_target_s: float = 0.25,
+        rpc_latency_target_s: float = 5.0,
+        floodwait_rate_threshold: float = 0.2,
+        interval_s: float = 10.0,
+        increase_step: int = 1,
+        decrease_factor: float = 0.5,
+        history_size: int = 20,
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.db_latency_target_s = db_latency_target_s
+        self.rpc_latency_target_s = rpc_latency_target_s
+        self.floodwait_rate_threshold = floodwait_rate_threshold
+        self.interval_s = interval_s
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self._limit = self._clamp(initial)
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+        self._window_started = monotonic()
+        self._reset_window()
+
+    def reconfigure(self, cfg) -> None:
+        """Apply bounds/targets from Settings (startup and SIGHUP reload); the limit is re-clamped."""
+        self.min_limit = max(1, cfg.worker_pool_min)
+        self.max_limit = max(self.min_limit, cfg.pool_max)
+        self.db_latency_target_s = cfg.worker_db_latency_target_ms / 1000
+        self.rpc_latency_target_s = cfg.worker_rpc_latency_target_ms / 1000
+        self.floodwait_rate_threshold = cfg.worker_floodwait_rate_threshold
+        self.interval_s = cfg.worker_adjust_interval_s
+        old, self._limit = self._limit, self._clamp(self._limit)
+        logger.info("worker.concurrency.bounds", min=self.min_limit, max=self.max_limit, old=old, new=self._limit)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def _clamp(self, value: int) -> int:
+        return max(self.min_limit, min(self.max_limit, int(value)))
+
+    def _reset_window(self) -> None:
+        self._db: List[float] = []
+        self._rpc: List[float] = []
+        self._lag: List[float] = []
+        self._lock_timeouts = 0
+        self._floodwaits = 0
+        self._saturated = False
+
+    # --- signals -----------------------------------------------------------
+
+    def record_db(self, latency_s: float) -> None:
+        self._db.append(latency_s)
+
+    def record_rpc(self, latency_s: float) -> None:
+        self._rpc.append(latency_s)
+
+    def record_queue_lag(self, lag_s: float) -> None:
+        self._lag.append(max(0.0, lag_s))
+
+    def record_lock_timeout(self) -> None:
+        self._lock_timeouts += 1
+
+    def record_floodwait(self) -> None:
+        self._floodwaits += 1
+
+    def record_saturated(self) -> None:
+        """All slots were busy while more ready jobs were waiting."""
+        self._saturated = True
+
+    # --- decisions ---------------------------------------------------------
+
+    def maybe_adjust(self, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        now = monotonic() if now is None else now
+        if now - self._window_started < self.interval_s:
+            return None
+        self._window_started = now
+        decision = self._decide()
+        self._reset_window()
+        return decision
+
+    def _decide(self) -> Dict[str, Any]:
+        old = self._limit
+        db_p90 = _p90(self._db)
+        rpc_p90 = _p90(self._rpc)
+        lag_p90 = _p90(self._lag)
+        # RPCs that returned (success or error) plus the ones answered with FloodWait
+        attempts = len(self._rpc) + self._floodwaits
+        floodwait_rate = self._floodwaits / attempts if attempts else 0.0
+
+        if self._lock_timeouts:
+            new = self._clamp(math.floor(old * self.decrease_factor))
+            reason = "congestion"
+        elif floodwait_rate > self.floodwait_rate_threshold:
+            new = self._clamp(old - 1)
+            reason = "floodwait_rate"
+        elif db_p90 is not None and db_p90 > self.db_latency_target_s:
+            new = self._clamp(old - 1)
+            reason = "db_latency"
+        elif rpc_p90 is not None and rpc_p90 > self.rpc_latency_target_s:
+            new = self._clamp(old - 1)
+            reason = "rpc_latency"
+        elif self._saturated:
+            new = self._clamp(old + self.increase_step)
+            reason = "saturated"
+        else:
+            new = old
+            reason = "hold"
+
+        self._limit = new
+        decision = {
+            "old": old,
+            "new": new,
+            "reason": reason,
+            "min": self.min_limit,
+            "max": self.max_limit,
+            "db_p90_ms": None if db_p90 is None else round(db_p90 * 1000, 1),
+            "rpc_p90_ms": None if rpc_p90 is None else round(rpc_p90 * 1000, 1),
+            "queue_lag_p90_s": None if lag_p90 is None else round(lag_p90, 1),
+            "lock_timeouts": self._lock_timeouts,
+            "floodwaits": self._floodwaits,
+            "floodwait_rate": round(floodwait_rate, 3),
+        }
+        self.history.append(decision)
+        if new != old:
+            logger.info("worker.concurrency.adjust", **decision)
+        else:
+            logger.debug("worker.concurrency.hold", **decision)
+        return decision
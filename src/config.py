@@ -1,16 +1,25 @@
-from pydantic import Field
+from pydantic import Field, ValidationError
 from pydantic_settings import BaseSettings
-from typing import Optional, List
+from typing import Any, Callable, Dict, Optional, List
+import asyncio
 import os
+import signal
+import threading
 
 class Settings(BaseSettings):
-    bot_token: str = Field(alias="BOT_TOKEN")
-    database_url: str = Field(alias="DATABASE_URL")
-    fernet_key: str = Field(alias="FERNET_KEY")
+    bot_token: Optional[str] = Field(None, alias="BOT_TOKEN")
+    api_id: Optional[int] = Field(None, alias="API_ID")
+    api_hash: Optional[str] = Field(None, alias="API_HASH")
+    database_url: str = Field("sqlite+aiosqlite:///./data.db", alias="DATABASE_URL")
+    database_read_url: Optional[str] = Field(None, alias="DATABASE_READ_URL")  # Postgres replica
+    read_your_writes_window_s: float = Field(5, alias="READ_YOUR_WRITES_WINDOW_SECONDS")
+    fernet_key: Optional[str] = Field(None, alias="FERNET_KEY")
+    stats_cache_ttl_s: float = Field(5, alias="STATS_CACHE_TTL_SECONDS")  # 0 disables (coalescing only)
 
     target_per_24h: int = Field(48, alias="TARGET_PER_24H")
     min_delay_s: int = Field(600, alias="MIN_DELAY_SECONDS")
     max_delay_s: int = Field(3600, alias="MAX_DELAY_SECONDS")
+    schedule_jitter_s: int = Field(300, alias="SCHEDULE_JITTER_SECONDS")
     max_attempts_per_group: int = Field(3, alias="MAX_ATTEMPTS_PER_GROUP")
     concurrent_workers_per_account: int = Field(1, alias="CONCURRENT_WORKERS_PER_ACCOUNT")
     log_retention_days: int = Field(30, alias="LOG_RETENTION_DAYS")
@@ -19,8 +28,119 @@ class Settings(BaseSettings):
     group_title_prefix: str = Field("", alias="GROUP_TITLE_PREFIX")
     admin_user_ids: Optional[str] = Field("", alias="ADMIN_USER_IDS")
 
+    # worker
+    job_lease_s: int = Field(900, alias="JOB_LEASE_SECONDS")
+    job_reclaim_interval_s: float = Field(60, alias="JOB_RECLAIM_INTERVAL_SECONDS")
+    worker_drain_timeout_s: float = Field(30, alias="WORKER_DRAIN_TIMEOUT_SECONDS")
+    worker_pool_min: int = Field(1, alias="WORKER_POOL_MIN")
+    worker_pool_max: Optional[int] = Field(None, alias="WORKER_POOL_MAX")  # default: max(pool, 8)
+    worker_db_latency_target_ms: int = Field(250, alias="WORKER_DB_LATENCY_TARGET_MS")
+    worker_rpc_latency_target_ms: int = Field(5000, alias="WORKER_RPC_LATENCY_TARGET_MS")
+    worker_floodwait_rate_threshold: float = Field(0.2, alias="WORKER_FLOODWAIT_RATE_THRESHOLD")  # floodwaits / RPC attempts
+    worker_adjust_interval_s: float = Field(10, alias="WORKER_ADJUST_INTERVAL_SECONDS")
+
+    # per-account circuit breaker
+    circuit_failure_threshold: int = Field(3, alias="CIRCUIT_FAILURE_THRESHOLD")  # consecutive transient failures
+    circuit_open_base_s: int = Field(300, alias="CIRCUIT_OPEN_BASE_SECONDS")
+    circuit_auth_open_base_s: int = Field(3600, alias="CIRCUIT_AUTH_OPEN_BASE_SECONDS")
+    circuit_open_max_s: int = Field(86400, alias="CIRCUIT_OPEN_MAX_SECONDS")
+
+    # owner digests
+    digest_window_s: int = Field(600, alias="DIGEST_WINDOW_SECONDS")
+    digest_page_size: int = Field(500, alias="DIGEST_PAGE_SIZE")
+    digest_max_events_per_window: int = Field(10000, alias="DIGEST_MAX_EVENTS_PER_WINDOW")
+    digest_send_interval_s: float = Field(0.1, alias="DIGEST_SEND_INTERVAL_SECONDS")
+    digest_max_send_windows: int = Field(3, alias="DIGEST_MAX_SEND_WINDOWS")
+
+    # logging
+    log_level: str = Field("INFO", alias="LOG_LEVEL")
+    log_queue_size: int = Field(10000, alias="LOG_QUEUE_SIZE")
+    log_rate_per_event_per_second: float = Field(20, alias="LOG_RATE_PER_EVENT_PER_SECOND")
+    log_burst_per_event: int = Field(100, alias="LOG_BURST_PER_EVENT")
+
     class Config:
         env_file = os.getenv("ENV_FILE", ".env")
         case_sensitive = True
+        extra = "ignore"
+        populate_by_name = True
+
+    @property
+    def pool_max(self) -> int:
+        return self.worker_pool_max or max(self.concurrent_workers_per_account, 8)
+
+class _ReloadSettings(Settings):
+    # On reload the env file wins over the process environment: under systemd
+    # EnvironmentFile= the process env still holds the values from startup.
+    @classmethod
+    def settings_customise_sources(cls, settings_cls, init_settings, env_settings, dotenv_settings, file_secret_settings):
+        return init_settings, dotenv_settings, env_settings, file_secret_settings
+
+# Connection/credential settings are bound at startup (engine, Fernet, clients).
+RESTART_ONLY = {"bot_token", "api_id", "api_hash", "database_url", "database_read_url", "fernet_key"}
+
+_settings: Optional[Settings] = None
+_lock = threading.Lock()
+_reload_callbacks: List[Callable[[Settings], None]] = []
+
+def get_settings() -> Settings:
+    """Process-wide settings, loaded on first use. Read attributes at use time so reloads apply."""
+    global _settings
+    if _settings is None:
+        with _lock:
+            if _settings is None:
+                _settings = Settings()
+    return _settings
+
+def on_reload(callback: Callable[[Settings], None]) -> None:
+    _reload_callbacks.append(callback)
+
+def reload_settings() -> Dict[str, Any]:
+    """
+    Re-read the env file and swap in new tunables. Restart-only fields keep
+    their current value. Returns {field: (old, new)} for applied changes.
+    An invalid value (e.g. TARGET_PER_24H=abc) is logged and the current
+    settings stay in place; this runs as a bare SIGHUP callback.
+    """
+    from .utils import logger
+    global _settings
+    old = get_settings()
+    try:
+        fresh = _ReloadSettings()
+    except ValidationError as e:
+        # field and reason only: the rejected input may be a secret
+        errors = {".".join(str(p) for p in err["loc"]): err["msg"] for err in e.errors()}
+        logger.error("settings.reload.error", errors=errors)
+        return {}
+    except Exception as e:
+        logger.exception("settings.reload.error", error=str(e))
+        return {}
+    values = fresh.model_dump()
+    changed: Dict[str, Any] = {}
+    ignored = []
+    for name, new in values.items():
+        cur = getattr(old, name)
+        if new == cur:
+            continue
+        if name in RESTART_ONLY:
+            values[name] = cur
+            ignored.append(name)
+        else:
+            changed[name] = (cur, new)
+    with _lock:
+        _settings = Settings.model_construct(**values)
+    if ignored:
+        logger.warning("settings.reload.restart_required", fields=ignored)
+    logger.info("settings.reload", changed={k: v[1] for k, v in changed.items()})
+    for cb in list(_reload_callbacks):
+        try:
+            cb(_settings)
+        except Exception as e:
+            logger.exception("settings.reload.callback_error", error=str(e))
+    return changed
 
-settings = Settings()
+def install_reload_handler() -> None:
+    """Reload tunables on SIGHUP (call from inside the running event loop)."""
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_settings)
+    except (NotImplementedError, RuntimeError, AttributeError):
+        pass
@@ -1,23 +1,31 @@
-from dotenv import load_dotenv
-load_dotenv()
-from telethon import TelegramClient
+from __future__ import annotations
+from typing import TYPE_CHECKING, Optional
 import asyncio
-import os
 from cryptography.fernet import Fernet, InvalidToken
+from .config import get_settings
 
-FERNET_KEY = os.getenv("FERNET_KEY")
-if not FERNET_KEY:
-    raise RuntimeError("FERNET_KEY not set. Generate one and put it in .env")
+if TYPE_CHECKING:
+    from telethon import TelegramClient
 
-# Fernet expects bytes
-fernet = Fernet(FERNET_KEY.encode())
+_fernet: Optional[Fernet] = None
+
+def get_fernet() -> Fernet:
+    """Build the Fernet instance on first use so importing this module never fails."""
+    global _fernet
+    if _fernet is None:
+        key = get_settings().fernet_key
+        if not key:
+            raise RuntimeError("FERNET_KEY not set. Generate one and put it in .env")
+        # Fernet expects bytes
+        _fernet = Fernet(key.encode())
+    return _fernet
 
 def encrypt_bytes(data: bytes) -> bytes:
-    return fernet.encrypt(data)
+    return get_fernet().encrypt(data)
 
 def decrypt_bytes(token: bytes) -> bytes:
     try:
-        return fernet.decrypt(token)
+        return get_fernet().decrypt(token)
     except InvalidToken:
         raise ValueError("Invalid encryption token")
 
@@ -27,31 +35,29 @@ def encrypt_str(s: str) -> bytes:
 def decrypt_str(token: bytes) -> str:
     return decrypt_bytes(token).decode()
 
-api_id_str = os.getenv("API_ID")
-api_hash = os.getenv("API_HASH")
-
-if not api_id_str or not api_hash:
-    raise RuntimeError("API_ID and API_HASH must be set in the environment (e.g. in .env)")
-
-try:
-    api_id = int(api_id_str)
-except ValueError:
-    raise RuntimeError("API_ID must be an integer")
+def api_credentials():
+    """(api_id, api_hash) of the bot application, validated at use time."""
+    cfg = get_settings()
+    if not cfg.api_id or not cfg.api_hash:
+        raise RuntimeError("API_ID and API_HASH must be set in the environment (e.g. in .env)")
+    return cfg.api_id, cfg.api_hash
 
 _bot = None
 
 async def get_bot() -> TelegramClient:
     """Create or reuse a single TelegramClient instance safely."""
+    from telethon import TelegramClient
     global _bot
     if _bot is None:
+        api_id, api_hash = api_credentials()
         # ensure there is an event loop for Telethon
         loop = asyncio.get_running_loop()
         _bot = TelegramClient("bot_session", api_id, api_hash, loop=loop)
-        
-        bot_token = os.getenv("BOT_TOKEN")
+
+        bot_token = get_settings().bot_token
         if not bot_token:
             raise RuntimeError("BOT_TOKEN not set in .env")
-        
+
         await _bot.start(bot_token=bot_token)
     return _bot
 
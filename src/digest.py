@@ -0,0 +1,173 @@
+from __future__ import annotations
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
+import asyncio
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import EventLog, SessionLocal
+from .utils import logger, now_utc
+from .config import get_settings
+
+# Owner notifications: undelivered events written by notify() are streamed
+# in id order (keyset pagination over the idx_event_logs_pending partial
+# index), grouped per owner and sent as a single digest message per owner
+# per window. Each owner's events are then marked delivered in bulk.
+#
+# Delivery is tracked per row, not with a high-water mark: on Postgres ids
+# are assigned at insert time, so a lower id can commit after higher ones
+# have been delivered. Such a row is simply still pending next window.
+#
+# A digest that cannot be sent (RETRY) leaves its events pending, but each
+# failed window is counted on the rows; after DIGEST_MAX_SEND_WINDOWS they
+# are given up on and marked delivered. Otherwise one owner whose sends keep
+# failing would pile up at the head of the oldest-first scan and, once past
+# DIGEST_MAX_EVENTS_PER_WINDOW, starve every other owner.
+
+# Window, page size and send pacing come from get_settings() (digest_*).
+# Bots may send ~30 msgs/s overall; the default pacing stays well below that.
+DIGEST_LATEST_LINES = 5
+MAX_MESSAGE_LEN = 4000
+SEND_ATTEMPTS = 3
+MARK_CHUNK = 500
+
+SENT, DROPPED, RETRY = "sent", "dropped", "retry"
+
+Sender = Callable[[int, str], Awaitable[None]]
+
+def pending_events_query(after_id: int, limit: int):
+    return (
+        select(EventLog.id, EventLog.owner_id, EventLog.level, EventLog.code, EventLog.message)
+        .where(EventLog.delivered_at.is_(None), EventLog.id > after_id)
+        .order_by(EventLog.id.asc())
+        .limit(limit)
+    )
+
+async def fetch_pending_after(session: AsyncSession, after_id: int, limit: int) -> List[Tuple[int, int, str, str, str]]:
+    res = await session.execute(pending_events_query(after_id, limit))
+    return [tuple(r) for r in res.all()]
+
+def build_digest(rows: List[Tuple[int, int, str, str, str]]) -> str:
+    counts = Counter(code or level for (_, _, level, code, _) in rows)
+    lines = [f"📬 خلاصه رویدادها ({len(rows)} مورد)"]
+    for code, n in counts.most_common():
+        lines.append(f"• {code}: {n}")
+    latest = [msg for (_, _, _, _, msg) in rows[-DIGEST_LATEST_LINES:] if msg]
+    if latest:
+        lines.append("آخرین رویدادها:")
+        lines.extend(f"- {m}" for m in latest)
+    text = "\n".join(lines)
+    return text if len(text) <= MAX_MESSAGE_LEN else text[:MAX_MESSAGE_LEN - 1] + "…"
+
+async def _send_with_retry(send: Sender, owner_id: int, text: str) -> str:
+    """
+    SENT, DROPPED (the owner can never receive it: blocked bot, deleted or
+    unknown chat) or RETRY (keep the events for the next window).
+    """
+    from telethon.errors import (
+        FloodWaitError, UserIsBlockedError, InputUserDeactivatedError, PeerIdInvalidError,
+        UserDeactivatedError, UserDeactivatedBanError,
+    )
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        try:
+            await send(owner_id, text)
+            return SENT
+        except FloodWaitError as e:
+            logger.warning("digest.send.floodwait", owner_id=owner_id, seconds=e.seconds, attempt=attempt)
+            if attempt < SEND_ATTEMPTS:
+                await asyncio.sleep(e.seconds + 1)
+        except (UserIsBlockedError, InputUserDeactivatedError, PeerIdInvalidError,
+                UserDeactivatedError, UserDeactivatedBanError, ValueError) as e:
+            # ValueError: Telethon cannot resolve the entity (the owner never opened the bot)
+            logger.warning("digest.send.undeliverable", owner_id=owner_id, error=str(e))
+            return DROPPED
+        except Exception as e:
+            logger.warning("digest.send.error", owner_id=owner_id, error=str(e))
+            return RETRY
+    return RETRY
+
+async def _mark_delivered(session: AsyncSession, ids: List[int]) -> None:
+    now = now_utc()
+    for i in range(0, len(ids), MARK_CHUNK):
+        await session.execute(
+            update(EventLog).where(EventLog.id.in_(ids[i:i + MARK_CHUNK])).values(delivered_at=now)
+            .execution_options(synchronize_session=False)
+        )
+    await session.commit()
+
+async def _record_failed_window(session: AsyncSession, ids: List[int], max_windows: int) -> int:
+    """Count a failed send against the events; returns how many hit the cap and were given up on."""
+    now = now_utc()
+    gave_up = 0
+    for i in range(0, len(ids), MARK_CHUNK):
+        chunk = ids[i:i + MARK_CHUNK]
+        await session.execute(
+            update(EventLog).where(EventLog.id.in_(chunk)).values(delivery_attempts=EventLog.delivery_attempts + 1)
+            .execution_options(synchronize_session=False)
+        )
+        res = await session.execute(
+            update(EventLog).where(EventLog.id.in_(chunk), EventLog.delivery_attempts >= max_windows)
+            .values(delivered_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        gave_up += res.rowcount or 0
+    await session.commit()
+    return gave_up
+
+async def deliver_digests(send: Sender) -> int:
+    """
+    Send one digest per owner for the pending events and mark them delivered.
+    Returns the number of events delivered (or dropped as undeliverable, or
+    given up on after DIGEST_MAX_SEND_WINDOWS failed windows).
+    """
+    cfg = get_settings()
+    async with SessionLocal() as s:
+        per_owner: "OrderedDict[int, List[Tuple[int, int, str, str, str]]]" = OrderedDict()
+        total = 0
+        last_id = 0
+        while total < cfg.digest_max_events_per_window:
+            page = await fetch_pending_after(s, last_id, min(cfg.digest_page_size, cfg.digest_max_events_per_window - total))
+            if not page:
+                break
+            for row in page:
+                per_owner.setdefault(row[1], []).append(row)
+            total += len(page)
+            last_id = page[-1][0]
+        # end the read transaction before the (slow) sends so writers are not held up
+        await s.commit()
+        if not total:
+            return 0
+
+        outcomes: Counter = Counter()
+        delivered = 0
+        for owner_id, rows in per_owner.items():
+            outcome = await _send_with_retry(send, owner_id, build_digest(rows))
+            outcomes[outcome] += 1
+            ids = [r[0] for r in rows]
+            if outcome != RETRY:
+                await _mark_delivered(s, ids)
+                delivered += len(rows)
+            else:
+                gave_up = await _record_failed_window(s, ids, cfg.digest_max_send_windows)
+                if gave_up:
+                    logger.warning("digest.send.gave_up", owner_id=owner_id, events=gave_up,
+                                   windows=cfg.digest_max_send_windows)
+                    delivered += gave_up
+            await asyncio.sleep(cfg.digest_send_interval_s)
+    logger.info("digest.delivered", events=total, delivered=delivered, owners=len(per_owner), **outcomes)
+    return delivered
+
+async def digest_loop(send: Sender, stop_event: Optional[asyncio.Event] = None, window_s: Optional[int] = None):
+    stop_event = stop_event or asyncio.Event()
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=window_s or get_settings().digest_window_s)
+        except asyncio.TimeoutError:
+            pass
+        if stop_event.is_set():
+            break
+        try:
+            await deliver_digests(send)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("digest.loop.error", error=str(e))
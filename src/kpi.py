@@ -1,34 +1,36 @@
 from sqlalchemy import select, func, text
-from .models import SessionLocal, Account, GroupStat, Job
+from .models import read_session, READ_YOUR_WRITES, Account, GroupStat, Job
 from datetime import timedelta, timezone
 from .utils import now_utc
+from .cache import SingleFlightCache
+from .config import get_settings
 from typing import Optional
 
-async def my_stats(owner_id: int):
-    async with SessionLocal() as s:
+def stats_queries(owner_id: int, since):
+    """The statements behind my_stats (also used by the query-plan check)."""
+    return {
         # active accounts
-        q_active = await s.execute(select(func.count()).select_from(Account).where(Account.owner_id==owner_id, Account.is_active==True))
-        active_accounts = q_active.scalar_one()
-
+        "active": select(func.count()).select_from(Account).where(Account.owner_id==owner_id, Account.is_active==True),
         # groups last 24h
-        since = now_utc() - timedelta(hours=24)
-        q_groups = await s.execute(select(func.count()).select_from(GroupStat).join(Account, Account.id==GroupStat.account_id).where(Account.owner_id==owner_id, GroupStat.created_at>=since))
-        groups_24h = q_groups.scalar_one()
-
+        "groups": select(func.count()).select_from(GroupStat).join(Account, Account.id==GroupStat.account_id).where(Account.owner_id==owner_id, GroupStat.created_at>=since),
         # queued jobs (owner)
-        q_jobs = await s.execute(select(func.count()).select_from(Job).join(Account, Account.id==Job.account_id).where(Account.owner_id==owner_id, Job.status.in_(["queued","running"])))
-        jobs_q = q_jobs.scalar_one()
-
+        "queued": select(func.count()).select_from(Job).join(Account, Account.id==Job.account_id).where(Account.owner_id==owner_id, Job.status.in_(["queued","running"])),
         # failed jobs
-        q_fail = await s.execute(select(func.count()).select_from(Job).join(Account, Account.id==Job.account_id).where(Account.owner_id==owner_id, Job.status=="failed"))
-        jobs_failed = q_fail.scalar_one()
-
+        "failed": select(func.count()).select_from(Job).join(Account, Account.id==Job.account_id).where(Account.owner_id==owner_id, Job.status=="failed"),
         # next run eta (minutes) across queued jobs for this owner
-        q_next = await s.execute(
-            select(func.min(Job.next_run_at)).select_from(Job).join(Account, Account.id==Job.account_id).where(
-                Account.owner_id==owner_id, Job.status=="queued"
-            )
-        )
+        "next": select(func.min(Job.next_run_at)).select_from(Job).join(Account, Account.id==Job.account_id).where(
+            Account.owner_id==owner_id, Job.status=="queued"
+        ),
+    }
+
+async def my_stats(owner_id: int, consistency: str = READ_YOUR_WRITES):
+    queries = stats_queries(owner_id, now_utc() - timedelta(hours=24))
+    async with read_session(owner_id, consistency) as s:
+        active_accounts = (await s.execute(queries["active"])).scalar_one()
+        groups_24h = (await s.execute(queries["groups"])).scalar_one()
+        jobs_q = (await s.execute(queries["queued"])).scalar_one()
+        jobs_failed = (await s.execute(queries["failed"])).scalar_one()
+        q_next = await s.execute(queries["next"])
         next_dt = q_next.scalar_one()
         next_minutes: Optional[int] = None
         if next_dt is not None:
@@ -40,3 +42,16 @@ async def my_stats(owner_id: int):
             next_minutes = max(0, int((delta + 59) // 60))  # ceil to minutes
 
         return active_accounts, groups_24h, jobs_q, jobs_failed, next_minutes
+
+_stats_cache = SingleFlightCache()
+
+async def cached_my_stats(owner_id: int):
+    """
+    my_stats for the bot handlers: concurrent requests from one owner share a
+    single computation and the result is reused for STATS_CACHE_TTL_SECONDS.
+    Call invalidate_stats(owner_id) after that owner's accounts/jobs change.
+    """
+    return await _stats_cache.get(owner_id, lambda: my_stats(owner_id), get_settings().stats_cache_ttl_s)
+
+def invalidate_stats(owner_id: int) -> None:
+    _stats_cache.invalidate(owner_id)
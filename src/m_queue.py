@@ -1,35 +1,36 @@
 from __future__ import annotations
-from typing import List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Union
 import json
 from datetime import timedelta
-from sqlalchemy import select, update, and_
+from sqlalchemy import DateTime, select, insert, update, and_, func, exists, literal
 from sqlalchemy.ext.asyncio import AsyncSession
-from telethon import functions
-from telethon.errors import FloodWaitError, SessionPasswordNeededError, RPCError
+from typing import TYPE_CHECKING
+from .config import get_settings
 from .models import Job, Account, GroupStat, EventLog , SessionLocal
 from .crypto import decrypt_str
-from .utils import now_utc, jitter, rand_delay, logger
+from .utils import now_utc, as_utc, jitter, rand_delay, logger, get_clock
+from .concurrency import AdaptiveConcurrency, is_lock_timeout
+from . import circuit
 import math
 import asyncio
 import random
-import os
+import time
 
-MIN_DELAY = int(os.getenv("MIN_DELAY_SECONDS", "600"))
-MAX_DELAY = int(os.getenv("MAX_DELAY_SECONDS", "3600"))
-MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS_PER_GROUP", "3"))
-FLOODWAIT_THRESHOLD = int(os.getenv("FLOODWAIT_THRESHOLD_SECONDS_PER_24H", "3600"))
-GROUP_PREFIX = os.getenv("GROUP_TITLE_PREFIX", "")
-TARGET_PER_24H = int(os.getenv("TARGET_PER_24H", "48"))
-SCHEDULE_JITTER_SECONDS = int(os.getenv("SCHEDULE_JITTER_SECONDS", "300"))  # پیش‌فرض 5 دقیقه
+if TYPE_CHECKING:
+    from telethon import TelegramClient
+
+# Tunables (TARGET_PER_24H, delays, jitter, attempts, ...) are read from
+# get_settings() at use time so a SIGHUP reload applies to the next job.
 
 def _compute_delay_seconds() -> int:
     """
     Deterministic interval based on TARGET_PER_24H with symmetric jitter.
     Falls back to MIN/MAX when TARGET_PER_24H <= 0.
     """
-    if TARGET_PER_24H and TARGET_PER_24H > 0:
-        base = int(math.ceil(86400 / TARGET_PER_24H))
-        j = jitter(SCHEDULE_JITTER_SECONDS)
+    cfg = get_settings()
+    if cfg.target_per_24h and cfg.target_per_24h > 0:
+        base = int(math.ceil(86400 / cfg.target_per_24h))
+        j = jitter(cfg.schedule_jitter_s)
         # symmetric jitter: +/- j
         if random.randint(0, 1) == 0:
             delay = base + j
@@ -37,43 +38,162 @@ def _compute_delay_seconds() -> int:
             delay = max(1, base - j)
         return delay
     # fallback legacy random window
-    return rand_delay(MIN_DELAY, MAX_DELAY)
+    return rand_delay(cfg.min_delay_s, cfg.max_delay_s)
 
-from telethon import TelegramClient
-from telethon.sessions import StringSession
+def _retry_delay_seconds(attempts: int) -> int:
+    """Exponential backoff before retry number `attempts` of a failed job."""
+    return 2 ** attempts * 10 + jitter(20)
 
-async def lease_next_job(session: AsyncSession) ->Optional[Job] :
-    # NOTE: For SQLite, true cross-process locking is limited.
-    # In Postgres, use SKIP LOCKED.
-    # Here we do a simple "take first ready" pattern within a transaction.
-    now = now_utc()
-    q = await session.execute(
+def _floodwait_delay_seconds(wait_s: int) -> int:
+    """Requeue delay after a FloodWait: the wait Telegram asked for plus a little jitter."""
+    return wait_s + jitter(30)
+
+def ready_jobs_query(now, limit: int = 1):
+    # earliest due first; walks idx_jobs_ready (status, next_run_at) in order, no sort step.
+    # Open-circuit accounts are skipped with a primary-key probe per candidate;
+    # their jobs are normally already pushed past the open period anyway.
+    return (
         select(Job)
         .where(and_(Job.status=="queued", Job.next_run_at<=now))
-        .order_by(Job.id.asc())
-        .limit(1)
+        .where(~exists().where(Account.id == Job.account_id, circuit.blocked_clause(now)))
+        .order_by(Job.next_run_at.asc(), Job.id.asc())
+        .limit(limit)
     )
+
+async def lease_next_job(session: AsyncSession, controller: Optional[AdaptiveConcurrency] = None) -> Optional[Job]:
+    """
+    Take the first ready job and flip it to `running`.
+
+    While a job is running, `next_run_at` holds its lease expiry
+    (now + JOB_LEASE_SECONDS). The worker renews it for jobs it still has in
+    flight; if the worker dies mid-job the lease runs out and
+    `reclaim_stale_jobs` puts the job back in the queue.
+    """
+    # NOTE: For SQLite, true cross-process locking is limited.
+    # In Postgres, use SKIP LOCKED.
+    # The conditional UPDATE below makes a lost race visible (rowcount 0).
+    now = now_utc()
+    q = await session.execute(ready_jobs_query(now))
     job = q.scalar_one_or_none()
-    if job:
-        job.status = "running"
-        await session.commit()
-        await session.refresh(job)
+    if not job:
+        return None
+    if controller:
+        controller.record_queue_lag((now - as_utc(job.next_run_at)).total_seconds())
+    res = await session.execute(
+        update(Job)
+        .where(Job.id == job.id, Job.status == "queued")
+        .values(status="running", next_run_at=now + timedelta(seconds=get_settings().job_lease_s))
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    if not res.rowcount:
+        return None
+    await session.refresh(job)
     return job
 
-async def schedule_next_for_account(session: AsyncSession, account: Account):
+async def renew_leases(session: AsyncSession, job_ids: List[int]) -> int:
+    """Push the lease of jobs this worker is still running (heartbeat), so slow jobs are not reclaimed."""
+    if not job_ids:
+        return 0
+    res = await session.execute(
+        update(Job)
+        .where(Job.id.in_(job_ids), Job.status == "running")
+        .values(next_run_at=now_utc() + timedelta(seconds=get_settings().job_lease_s))
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return res.rowcount or 0
+
+async def reclaim_stale_jobs(session: AsyncSession, exclude_ids: Iterable[int] = ()) -> int:
+    """
+    Requeue `running` jobs whose lease expired (the worker that held them died).
+    A reclaim counts as an attempt so a job that keeps killing the worker
+    eventually fails instead of looping forever. `exclude_ids` are jobs the
+    caller itself still has in flight.
+    """
+    now = now_utc()
+    stale = and_(Job.status == "running", Job.next_run_at <= now)
+    exclude_ids = list(exclude_ids)
+    if exclude_ids:
+        stale = and_(stale, Job.id.notin_(exclude_ids))
+    failed = await session.execute(
+        update(Job)
+        .where(stale, Job.attempts + 1 >= Job.max_attempts)
+        .values(status="failed", attempts=Job.attempts + 1, error="lease expired")
+        .execution_options(synchronize_session=False)
+    )
+    requeued = await session.execute(
+        update(Job)
+        .where(stale)
+        .values(status="queued", attempts=Job.attempts + 1, next_run_at=now, error="lease expired; requeued")
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    n = (failed.rowcount or 0) + (requeued.rowcount or 0)
+    if n:
+        logger.warning("worker.reclaim", requeued=requeued.rowcount, failed=failed.rowcount)
+    return n
+
+async def release_jobs(session: AsyncSession, job_ids: List[int]) -> int:
+    """Hand leased jobs back to the queue untouched (graceful shutdown)."""
+    if not job_ids:
+        return 0
+    res = await session.execute(
+        update(Job)
+        .where(Job.id.in_(job_ids), Job.status == "running")
+        .values(status="queued", next_run_at=now_utc())
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return res.rowcount or 0
+
+async def schedule_next_for_account(session: AsyncSession, account: Account) -> bool:
+    """
+    Queue the account's next job. The insert is conditional on the account
+    still being active in the DB (INSERT ... SELECT), so a job that finishes
+    after its account was disabled or paused does not schedule more work.
+    Returns False when nothing was queued.
+    """
     delay = _compute_delay_seconds()
+    run_at = now_utc() + timedelta(seconds=delay)
+    # not before an open circuit's next probe
+    blocked_until = circuit.not_before(account)
+    if blocked_until and blocked_until > run_at:
+        run_at = blocked_until
     # Enqueue new job
-    j = Job(
-        account_id=account.id,
-        type="CREATE_GROUP",
-        status="queued",
-        attempts=0,
-        max_attempts=MAX_ATTEMPTS,
-        payload="{}",
-        next_run_at=now_utc() + timedelta(seconds=delay),
+    res = await session.execute(
+        insert(Job).from_select(
+            ["account_id", "type", "status", "attempts", "max_attempts", "payload", "error", "next_run_at"],
+            select(
+                Account.id,
+                literal("CREATE_GROUP"),
+                literal("queued"),
+                literal(0),
+                literal(get_settings().max_attempts_per_group),
+                literal("{}"),
+                literal(""),
+                literal(run_at, DateTime(timezone=True)),
+            ).where(Account.id == account.id, Account.is_active == True)
+        )
     )
-    session.add(j)
     await session.commit()
+    return bool(res.rowcount)
+
+async def cancel_if_inactive(session: AsyncSession, job_id: int) -> bool:
+    """
+    Cancel a job that was put back in the queue after its account was
+    disabled or paused while the job was running (disable/pause only touch
+    jobs that are queued at the time). True if the job was cancelled.
+    """
+    res = await session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.status == "queued",
+               ~exists().where(Account.id == Job.account_id, Account.is_active == True))
+        .values(status="cancelled", error="account deactivated while the job was running")
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return bool(res.rowcount)
 
 async def notify(session: AsyncSession, owner_id: int, level: str, code: str, message: str):
     ev = EventLog(owner_id=owner_id, level=level, code=code, message=message)
@@ -81,6 +201,8 @@ async def notify(session: AsyncSession, owner_id: int, level: str, code: str, me
     await session.commit()
 
 async def create_telethon_client_from_account(account: Account) -> TelegramClient:
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
     api_id = int(account.api_id)
     api_hash = decrypt_str(account.api_hash_enc)
     session_str = decrypt_str(account.session_enc)
@@ -88,7 +210,40 @@ async def create_telethon_client_from_account(account: Account) -> TelegramClien
     await client.connect()
     return client
 
-async def process_job(job: Job):
+async def _trip_circuit(session: AsyncSession, job: Job, account: Account, exc: BaseException, client_init: bool = False) -> bool:
+    """
+    Feed an error to the account's circuit breaker. True if the circuit is now
+    open and the job has been put back for the next probe; False if the caller
+    should handle the job as usual.
+    """
+    kind = circuit.classify(exc, client_init)
+    if kind is None:
+        return False
+    was_closed = account.circuit_state == circuit.CLOSED
+    until = await circuit.record_failure(session, job, account, kind, f"{exc.__class__.__name__}: {exc}")
+    if until is None:
+        return False
+    if was_closed:
+        if kind == circuit.AUTH:
+            msg = f"نشست اکانت {account.phone} نامعتبر یا باطل شده است؛ کارهای آن متوقف شد. دوباره وارد شوید یا اکانت را حذف کنید."
+        else:
+            minutes = max(1, int((until - now_utc()).total_seconds() // 60))
+            msg = f"اتصال اکانت {account.phone} چند بار پشت سر هم ناموفق بود؛ کارهای آن تا {minutes} دقیقه دیگر متوقف شد."
+        await notify(session, account.owner_id, "error", "circuit_open", msg)
+    return True
+
+async def process_job(job: Job, controller: Optional[AdaptiveConcurrency] = None):
+    await _run_job(job, controller)
+    # the FloodWait/retry/circuit paths requeue the job; if the account was
+    # deactivated meanwhile, that requeue must not outlive it
+    async with SessionLocal() as s:
+        if await cancel_if_inactive(s, job.id):
+            logger.info("job.cancelled.inactive", job_id=job.id)
+
+async def _run_job(job: Job, controller: Optional[AdaptiveConcurrency] = None):
+    from telethon import functions
+    from telethon.errors import FloodWaitError, RPCError
+    cfg = get_settings()
     async with SessionLocal() as s:
         # reload with account
         job = await s.get(Job, job.id)
@@ -100,12 +255,25 @@ async def process_job(job: Job):
             job.error = "Account not found or inactive"
             await s.commit()
             return
+        # open circuit: requeue for the next probe without paying for decrypt/connect
+        if not await circuit.admit(s, job, account):
+            return
 
         # enforce per-account single concurrency: ensure there is no other running job for this account
         # (best-effort for SQLite single-process; for multi-process use DB-level locks)
         try:
             client = await create_telethon_client_from_account(account)
         except Exception as e:
+            if await _trip_circuit(s, job, account, e, client_init=True):
+                return
+            if circuit.classify(e, client_init=True) == circuit.TRANSIENT and job.attempts + 1 < job.max_attempts:
+                # network trouble: retry with backoff; repeated failures open the circuit
+                job.attempts += 1
+                job.status = "queued"
+                job.next_run_at = now_utc() + timedelta(seconds=_retry_delay_seconds(job.attempts))
+                job.error = f"ClientInitError: {e}; retrying"
+                await s.commit()
+                return
             job.status = "failed"
             job.error = f"ClientInitError: {e}"
             await s.commit()
@@ -113,28 +281,36 @@ async def process_job(job: Job):
             return
 
         try:
-            title = f"{GROUP_PREFIX} {random.randint(100000, 999999)}".strip()
+            title = f"{cfg.group_title_prefix} {random.randint(100000, 999999)}".strip()
+            rpc_started = time.monotonic()
             await client(functions.channels.CreateChannelRequest(
                 title=title,
                 about="",
                 megagroup=True
             ))
+            if controller:
+                controller.record_rpc(time.monotonic() - rpc_started)
             # success
             account.last_used_at = now_utc()
             s.add(GroupStat(account_id=account.id))
             job.status = "done"
+            job.error = ""
             await s.commit()
 
             await notify(s, account.owner_id, "info", "group_created", f"یک گروه جدید ساخته شد: {title}")
+            if await circuit.record_success(s, account):
+                await notify(s, account.owner_id, "info", "circuit_closed", f"اتصال اکانت {account.phone} دوباره برقرار شد؛ کارها از سر گرفته شد.")
 
             # schedule next to reach target
             await schedule_next_for_account(s, account)
 
         except FloodWaitError as fw:
+            if controller:
+                controller.record_floodwait()
             # schedule after floodwait + small jitter
             job.attempts += 1
             job.status = "queued"
-            wait_s = fw.seconds + jitter(30)
+            wait_s = _floodwait_delay_seconds(fw.seconds)
             job.next_run_at = now_utc() + timedelta(seconds=wait_s)
             await s.commit()
 
@@ -143,29 +319,36 @@ async def process_job(job: Job):
             await s.commit()
             await notify(s, account.owner_id, "warn", "floodwait", f"FloodWait {fw.seconds}s. اجرای بعدی بعد از {wait_s}s")
 
-            if account.total_floodwait_s_24h > FLOODWAIT_THRESHOLD:
-                account.is_active = False
-                await s.commit()
+            if account.total_floodwait_s_24h > cfg.floodwait_threshold_s_24h:
+                # pause (not disable) so the requeued job survives and resumes on enable
+                from .accounts import pause_account
+                await pause_account(s, account.id)
                 await notify(s, account.owner_id, "warn", "paused", "به دلیل FloodWait زیاد در 24 ساعت گذشته، اکانت موقتاً متوقف شد.")
         except RPCError as re:
+            if controller:
+                controller.record_rpc(time.monotonic() - rpc_started)
+            if await _trip_circuit(s, job, account, re):
+                return
             job.attempts += 1
             if job.attempts >= job.max_attempts:
                 job.status = "failed"
                 job.error = f"RPCError: {re.__class__.__name__}"
             else:
-                backoff = 2 ** job.attempts * 10 + jitter(20)
+                backoff = _retry_delay_seconds(job.attempts)
                 job.status = "queued"
                 job.next_run_at = now_utc() + timedelta(seconds=backoff)
                 job.error = f"retrying due to {re.__class__.__name__}"
             await s.commit()
             await notify(s, account.owner_id, "error", "rpc_error", "خطا در ساخت گروه؛ تلاش مجدد با backoff.")
         except Exception as e:
+            if await _trip_circuit(s, job, account, e):
+                return
             job.attempts += 1
             if job.attempts >= job.max_attempts:
                 job.status = "failed"
                 job.error = f"Unexpected: {e}"
             else:
-                backoff = 2 ** job.attempts * 10 + jitter(20)
+                backoff = _retry_delay_seconds(job.attempts)
                 job.status = "queued"
                 job.next_run_at = now_utc() + timedelta(seconds=backoff)
                 job.error = "Unexpected; retry later"
@@ -177,25 +360,130 @@ async def process_job(job: Job):
             except Exception:
                 pass
 
-async def worker_loop(pool_size: int = 4, stop_event: Optional[asyncio.Event] = None):
-    stop_event = stop_event or asyncio.Event()
+async def _lease(controller: AdaptiveConcurrency) -> Optional[Job]:
+    async with SessionLocal() as s:
+        started = time.monotonic()
+        try:
+            job = await lease_next_job(s, controller)
+        except Exception as e:
+            if not is_lock_timeout(e):
+                raise
+            controller.record_lock_timeout()
+            logger.warning("worker.lease.locked", error=str(e))
+            return None
+        controller.record_db(time.monotonic() - started)
+    return job
+
+async def next_due_at(session: AsyncSession):
+    # same filter as leasing, so a job held back by an open circuit does not keep the worker polling
+    res = await session.execute(
+        select(func.min(Job.next_run_at))
+        .where(Job.status == "queued")
+        .where(~exists().where(Account.id == Job.account_id, circuit.blocked_clause(now_utc())))
+    )
+    return res.scalar_one()
+
+async def _idle_seconds(cap_s: float) -> float:
+    """How long to sleep when the queue is empty: until the next job is due, at most `cap_s`."""
     async with SessionLocal() as s:
-        # initial
-        pass
+        due = await next_due_at(s)
+    if due is None:
+        return cap_s
+    return min(cap_s, max(0.0, (as_utc(due) - now_utc()).total_seconds()))
 
-    async def _one():
+async def _reclaim(inflight_ids: List[int]) -> None:
+    try:
         async with SessionLocal() as s:
-            job = await lease_next_job(s)
-            if not job:
-                await asyncio.sleep(1.0)
-                return
-            await process_job(job)
+            await renew_leases(s, inflight_ids)
+            await reclaim_stale_jobs(s, inflight_ids)
+    except Exception as e:
+        logger.warning("worker.reclaim.error", error=str(e))
+
+async def _drain(inflight: Dict[asyncio.Task, int], timeout_s: float) -> None:
+    """Wait for in-flight jobs up to `timeout_s`, then cancel and release the rest."""
+    if not inflight:
+        return
+    logger.info("worker.drain.begin", inflight=len(inflight), timeout_s=timeout_s)
+    _, pending = await asyncio.wait(list(inflight), timeout=timeout_s)
+    leftover = [inflight[t] for t in pending]
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    released = 0
+    if leftover:
+        async with SessionLocal() as s:
+            released = await release_jobs(s, leftover)
+    logger.info("worker.drain.done", released=released)
+
+async def worker_loop(
+    pool_size: int = 4,
+    stop_event: Optional[asyncio.Event] = None,
+    controller: Optional[AdaptiveConcurrency] = None,
+    reclaim_interval_s: Optional[float] = None,
+    drain_timeout_s: Optional[float] = None,
+    idle_poll_s: float = 1.0,
+):
+    """
+    Keep up to `controller.limit` jobs in flight. Without a controller the
+    pool is fixed at `pool_size` slots.
 
-    tasks = []
+    Setting `stop_event` stops leasing; in-flight jobs get `drain_timeout_s`
+    to finish and whatever is still running is released back to the queue.
+    Intervals left as None follow the (reloadable) settings.
+    Time is read and idled through the active clock (see utils.set_clock).
+    """
+    stop_event = stop_event or asyncio.Event()
+    controller = controller or AdaptiveConcurrency(pool_size, pool_size, pool_size)
+    clock = get_clock()
+    inflight: Dict[asyncio.Task, int] = {}  # task -> job id
+
+    def _done(t: asyncio.Task):
+        inflight.pop(t, None)
+        if t.cancelled():
+            return
+        exc = t.exception()
+        if exc is not None:
+            if is_lock_timeout(exc):
+                controller.record_lock_timeout()
+            logger.error("worker.job.crashed", error=repr(exc))
+
+    async def _wait_inflight(timeout: Optional[float]):
+        stopper = asyncio.ensure_future(stop_event.wait())
+        await asyncio.wait(list(inflight) + [stopper], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+
+    last_reclaim = clock.monotonic()
     try:
         while not stop_event.is_set():
-            # launch up to pool_size concurrent fetches
-            tasks = [asyncio.create_task(_one()) for _ in range(pool_size)]
-            await asyncio.gather(*tasks)
+            interval = reclaim_interval_s if reclaim_interval_s is not None else get_settings().job_reclaim_interval_s
+            if clock.monotonic() - last_reclaim >= interval:
+                last_reclaim = clock.monotonic()
+                await _reclaim(list(inflight.values()))
+            controller.maybe_adjust()
+            drained = False
+            while len(inflight) < controller.limit and not stop_event.is_set():
+                job = await _lease(controller)
+                if not job:
+                    drained = True
+                    break
+                t = asyncio.create_task(process_job(job, controller))
+                inflight[t] = job.id
+                t.add_done_callback(_done)
+
+            if not drained and len(inflight) >= controller.limit:
+                # every slot busy; ready work may still be waiting. Wake up for
+                # the next lease renewal / controller window even if no job ends.
+                controller.record_saturated()
+                until_reclaim = interval - (clock.monotonic() - last_reclaim)
+                await _wait_inflight(max(0.0, min(until_reclaim, controller.interval_s)))
+            elif inflight:
+                # queue drained; running jobs may schedule follow-ups
+                await _wait_inflight(idle_poll_s)
+            else:
+                await clock.wait(stop_event, await _idle_seconds(idle_poll_s))
     except asyncio.CancelledError:
-        return
+        drain_timeout_s = 0
+    finally:
+        if drain_timeout_s is None:
+            drain_timeout_s = get_settings().worker_drain_timeout_s
+        await _drain(inflight, drain_timeout_s)
@@ -0,0 +1,220 @@
+"""
+Versioned schema migrations.
+
+`run_migrations(engine)` runs on bot and worker startup. Applied versions are
+recorded in `schema_migrations`; each migration runs once, in order, inside
+the startup transaction. Migrations must be idempotent (check before
+create/alter) because the bot and the worker may start at the same time.
+Version 1 is a frozen copy of the original tables; every later change to
+src/models.py (new columns, indexes, tables) needs its own migration.
+
+    python -m src.migrations                # apply pending migrations
+    python -m src.migrations --check-plans  # EXPLAIN the hot queries, exit 1 on a full scan
+"""
+from __future__ import annotations
+from typing import Callable, Dict, List, Tuple
+import asyncio
+import sys
+from sqlalchemy import (
+    BigInteger, Boolean, Column, DateTime, ForeignKey, Index, Integer, LargeBinary, MetaData, String, Table, Text,
+    inspect, select, text,
+)
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import func
+from .models import Base, Account, EventLog, Job
+from .utils import logger, now_utc
+
+_meta = MetaData()
+schema_migrations = Table(
+    "schema_migrations", _meta,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(64), nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+def _create_indexes(conn: Connection, names: List[str]) -> None:
+    wanted = set(names)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in wanted:
+                index.create(conn, checkfirst=True)
+
+# Schema as it was when versioning was introduced, frozen here so that v1
+# means the same thing on every database. Never edit it: later schema
+# changes go into new migrations, which see exactly these tables on a fresh
+# database. (Migrations still check before create/alter - see above.)
+_v1 = MetaData()
+Table(
+    "users", _v1,
+    Column("id", BigInteger, primary_key=True),
+    Column("created_at", DateTime(timezone=True), server_default=func.now(), nullable=False),
+)
+Table(
+    "accounts", _v1,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("owner_id", BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    Column("api_id", String(32), nullable=False),
+    Column("api_hash_enc", LargeBinary, nullable=False),
+    Column("phone", String(32), nullable=False),
+    Column("session_enc", LargeBinary, nullable=False),
+    Column("is_active", Boolean, nullable=False),
+    Column("last_used_at", DateTime(timezone=True), nullable=True),
+    Column("total_floodwait_s_24h", Integer, nullable=False),
+)
+_v1_jobs = Table(
+    "jobs", _v1,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("account_id", Integer, ForeignKey("accounts.id", ondelete="CASCADE"), nullable=False),
+    Column("type", String(32), nullable=False),
+    Column("status", String(16), nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("max_attempts", Integer, nullable=False),
+    Column("next_run_at", DateTime(timezone=True), server_default=func.now(), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("error", Text, nullable=False),
+)
+Index("idx_jobs_ready", _v1_jobs.c.status, _v1_jobs.c.next_run_at)
+Table(
+    "group_stats", _v1,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("account_id", Integer, ForeignKey("accounts.id", ondelete="CASCADE"), nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.now(), nullable=False),
+)
+Table(
+    "event_logs", _v1,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("owner_id", BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    Column("account_id", Integer, ForeignKey("accounts.id", ondelete="SET NULL"), nullable=True),
+    Column("level", String(8), nullable=False),
+    Column("code", String(32), nullable=False),
+    Column("message", Text, nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.now(), nullable=False),
+)
+
+def _v1_baseline(conn: Connection) -> None:
+    # no-op on databases created before versioning
+    _v1.create_all(conn)
+
+def _v2_hot_path_indexes(conn: Connection) -> None:
+    _create_indexes(conn, [
+        "idx_jobs_account_status",
+        "idx_accounts_owner_active",
+        "idx_accounts_active",
+        "idx_group_stats_account_created",
+        "idx_event_logs_owner_created",
+    ])
+
+def _add_columns(conn: Connection, table: Table, names: List[str]) -> None:
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    for name in names:
+        if name not in existing:
+            ddl = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+def _v3_account_circuit(conn: Connection) -> None:
+    _add_columns(conn, Account.__table__, [
+        "circuit_state", "circuit_failures", "circuit_open_until", "circuit_error",
+    ])
+    _add_columns(conn, Job.__table__, ["circuit_hold"])
+
+def _v4_event_delivery(conn: Connection) -> None:
+    _add_columns(conn, EventLog.__table__, ["delivered_at"])
+    # existing events predate the digest: don't send the backlog
+    events = EventLog.__table__
+    conn.execute(events.update().where(events.c.delivered_at.is_(None)).values(delivered_at=now_utc()))
+    _create_indexes(conn, ["idx_event_logs_pending"])
+
+def _v5_event_delivery_attempts(conn: Connection) -> None:
+    _add_columns(conn, EventLog.__table__, ["delivery_attempts"])
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "baseline", _v1_baseline),
+    (2, "hot_path_indexes", _v2_hot_path_indexes),
+    (3, "account_circuit", _v3_account_circuit),
+    (4, "event_delivery", _v4_event_delivery),
+    (5, "event_delivery_attempts", _v5_event_delivery_attempts),
+]
+
+def _migrate(conn: Connection) -> List[int]:
+    if conn.dialect.name == "postgresql":
+        # serialize concurrent bot/worker startups
+        conn.execute(text("SELECT pg_advisory_xact_lock(724001)"))
+    _meta.create_all(conn)
+    applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
+    done = []
+    for version, name, fn in MIGRATIONS:
+        if version in applied:
+            continue
+        fn(conn)
+        conn.execute(schema_migrations.insert().values(version=version, name=name, applied_at=now_utc()))
+        done.append(version)
+    return done
+
+async def run_migrations(engine: AsyncEngine) -> List[int]:
+    """Apply pending migrations; returns the versions applied by this call."""
+    for attempt in range(2):
+        try:
+            async with engine.begin() as conn:
+                done = await conn.run_sync(_migrate)
+            break
+        except IntegrityError:
+            # another process recorded the same version first; re-read and continue
+            if attempt:
+                raise
+    logger.info("db.migrations", applied=done, current=MIGRATIONS[-1][0])
+    return done
+
+# --- query-plan regression check ---------------------------------------------
+
+def hot_queries() -> Dict[str, object]:
+    from .m_queue import ready_jobs_query
+    from .kpi import stats_queries
+    from .worker import bootstrap_query
+    from .digest import pending_events_query
+    now = now_utc()
+    queries: Dict[str, object] = {"lease_next_job": ready_jobs_query(now)}
+    for name, stmt in stats_queries(1, now).items():
+        queries[f"my_stats.{name}"] = stmt
+    queries["bootstrap_targets"] = bootstrap_query(now)
+    queries["digest_pending"] = pending_events_query(0, 500)
+    return queries
+
+def _explain(conn: Connection, stmt) -> List[str]:
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled)).all()
+    return [r[-1] for r in rows]
+
+def _is_full_scan(detail: str) -> bool:
+    # SQLite reports "SCAN jobs" / "SCAN TABLE jobs" for a table walk; SEARCH means an index lookup
+    return detail.startswith("SCAN") and "CONSTANT ROW" not in detail
+
+def check_query_plans(conn: Connection) -> Dict[str, List[str]]:
+    """EXPLAIN every hot query; returns {query: [full-scan plan lines]} for offenders (SQLite only)."""
+    if conn.dialect.name != "sqlite":
+        return {}
+    offenders: Dict[str, List[str]] = {}
+    for name, stmt in hot_queries().items():
+        scans = [d for d in _explain(conn, stmt) if _is_full_scan(d)]
+        if scans:
+            offenders[name] = scans
+    return offenders
+
+async def _main(argv: List[str]) -> int:
+    from .models import get_engine
+    engine = get_engine()
+    await run_migrations(engine)
+    if "--check-plans" not in argv:
+        return 0
+    async with engine.connect() as conn:
+        offenders = await conn.run_sync(check_query_plans)
+    for name, scans in offenders.items():
+        print(f"FULL SCAN {name}: {'; '.join(scans)}")
+    if not offenders:
+        print("query plans ok")
+    return 1 if offenders else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
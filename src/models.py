@@ -1,12 +1,11 @@
 from __future__ import annotations
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from typing import List
-from sqlalchemy import String, Integer, BigInteger, LargeBinary, DateTime, ForeignKey, Text, Boolean, Index
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs
+from typing import Dict, List, Optional
+import time
+from sqlalchemy import event, false, String, Integer, BigInteger, LargeBinary, DateTime, ForeignKey, Text, Boolean, Index
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs, AsyncEngine, AsyncSession
 from sqlalchemy.sql import func
-import os
-
-DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///./data.db")
+from .config import get_settings
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
@@ -15,7 +14,7 @@ class User(Base):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True)  # Telegram user id
     created_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), server_default=func.now())
-    accounts: Mapped[List["Account"]] = relationship(back_populates="owner", cascade="all, delete-orphan")
+    accounts: Mapped[List["Account"]] = relationship(back_populates="owner", cascade="all, delete-orphan", passive_deletes=True)
 
 class Account(Base):
     __tablename__ = "accounts"
@@ -28,25 +27,36 @@ class Account(Base):
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     last_used_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), nullable=True)
     total_floodwait_s_24h: Mapped[int] = mapped_column(Integer, default=0)
+    # circuit breaker (see src/circuit.py)
+    circuit_state: Mapped[str] = mapped_column(String(16), default="closed", server_default="closed")  # closed|open|half_open
+    circuit_failures: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    circuit_open_until: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), nullable=True)
+    circuit_error: Mapped[str] = mapped_column(Text, default="", server_default="")
 
     owner: Mapped["User"] = relationship(back_populates="accounts")
-    jobs: Mapped[List["Job"]] = relationship(back_populates="account", cascade="all, delete-orphan")
+    # rely on ON DELETE CASCADE instead of loading every job before deleting it
+    jobs: Mapped[List["Job"]] = relationship(back_populates="account", cascade="all, delete-orphan", passive_deletes=True)
 
 class Job(Base):
     __tablename__ = "jobs"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     account_id: Mapped[int] = mapped_column(ForeignKey("accounts.id", ondelete="CASCADE"))
     type: Mapped[str] = mapped_column(String(32), default="CREATE_GROUP")
-    status: Mapped[str] = mapped_column(String(16), default="queued")  # queued|running|done|failed|paused
+    status: Mapped[str] = mapped_column(String(16), default="queued")  # queued|running|done|failed|paused|cancelled
     attempts: Mapped[int] = mapped_column(Integer, default=0)
     max_attempts: Mapped[int] = mapped_column(Integer, default=3)
     next_run_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), server_default=func.now())
     payload: Mapped[str] = mapped_column(Text, default="{}")
     error: Mapped[str] = mapped_column(Text, default="")
+    circuit_hold: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())  # pushed back by an open circuit
 
     account: Mapped["Account"] = relationship(back_populates="jobs")
 
 Index("idx_jobs_ready", Job.status, Job.next_run_at)
+Index("idx_jobs_account_status", Job.account_id, Job.status)
+
+Index("idx_accounts_owner_active", Account.owner_id, Account.is_active)
+Index("idx_accounts_active", Account.is_active)
 
 class GroupStat(Base):
     __tablename__ = "group_stats"
@@ -54,6 +64,8 @@ class GroupStat(Base):
     account_id: Mapped[int] = mapped_column(ForeignKey("accounts.id", ondelete="CASCADE"))
     created_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
+Index("idx_group_stats_account_created", GroupStat.account_id, GroupStat.created_at)
+
 class EventLog(Base):
     __tablename__ = "event_logs"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
@@ -63,11 +75,104 @@ class EventLog(Base):
     code: Mapped[str] = mapped_column(String(32), default="")
     message: Mapped[str] = mapped_column(Text, default="")
     created_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    delivered_at: Mapped["DateTime"] = mapped_column(DateTime(timezone=True), nullable=True)  # owner digest
+    delivery_attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")  # failed digest windows
 
-engine = create_async_engine(
-    DATABASE_URL, 
-    echo=False, 
-    future=True,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
+Index("idx_event_logs_owner_created", EventLog.owner_id, EventLog.created_at)
+# only undelivered rows are indexed, so the digest scan stays small as the log grows
+Index(
+    "idx_event_logs_pending", EventLog.id,
+    sqlite_where=EventLog.delivered_at.is_(None), postgresql_where=EventLog.delivered_at.is_(None),
 )
-SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+
+# Engines are created on first use (not at import) from the central settings.
+# Writes go through the primary engine. Reads that can tolerate a little lag
+# go through a read engine: DATABASE_READ_URL (a replica) on Postgres, or a
+# separate query_only connection pool on the same WAL-mode file for SQLite,
+# so bot reads do not queue behind the worker's write transactions.
+_engine: Optional[AsyncEngine] = None
+_sessionmaker: Optional[async_sessionmaker] = None
+_read_engine: Optional[AsyncEngine] = None
+_read_sessionmaker: Optional[async_sessionmaker] = None
+
+# read consistency levels, declared by each call site
+EVENTUAL = "eventual"                   # replica / read pool
+READ_YOUR_WRITES = "read_your_writes"   # primary only if this owner wrote recently
+STRONG = "strong"                       # always primary
+
+_recent_writes: Dict[int, float] = {}  # owner_id -> monotonic time of last write
+
+def _sqlite_fk_pragma(dbapi_conn, _record):
+    # SQLite ignores ON DELETE CASCADE unless foreign keys are enabled per connection
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA foreign_keys=ON")
+    # WAL lets the read pool proceed while the worker holds the write lock
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.close()
+
+def _sqlite_read_pragma(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA query_only=ON")
+    cur.close()
+
+def _create_engine(url: str) -> AsyncEngine:
+    return create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        connect_args={"check_same_thread": False} if "sqlite" in url else {}
+    )
+
+def get_engine() -> AsyncEngine:
+    global _engine, _sessionmaker
+    if _engine is None:
+        url = get_settings().database_url
+        _engine = _create_engine(url)
+        if "sqlite" in url:
+            event.listen(_engine.sync_engine, "connect", _sqlite_fk_pragma)
+        _sessionmaker = async_sessionmaker(_engine, expire_on_commit=False)
+    return _engine
+
+def get_read_engine() -> AsyncEngine:
+    global _read_engine, _read_sessionmaker
+    if _read_engine is None:
+        cfg = get_settings()
+        if cfg.database_read_url:
+            _read_engine = _create_engine(cfg.database_read_url)
+        elif "sqlite" in cfg.database_url:
+            _read_engine = _create_engine(cfg.database_url)
+            event.listen(_read_engine.sync_engine, "connect", _sqlite_read_pragma)
+        else:
+            # Postgres without a replica: reads share the primary
+            _read_engine = get_engine()
+        _read_sessionmaker = async_sessionmaker(_read_engine, expire_on_commit=False)
+    return _read_engine
+
+def SessionLocal() -> AsyncSession:
+    """Open a read-write session on the primary: `async with SessionLocal() as s:`."""
+    if _sessionmaker is None:
+        get_engine()
+    return _sessionmaker()
+
+WriteSessionLocal = SessionLocal
+
+def ReadSessionLocal() -> AsyncSession:
+    """Open a session on the read engine (may lag the primary)."""
+    if _read_sessionmaker is None:
+        get_read_engine()
+    return _read_sessionmaker()
+
+def mark_owner_write(owner_id: int) -> None:
+    """Record that this owner's data just changed, for READ_YOUR_WRITES reads."""
+    _recent_writes[owner_id] = time.monotonic()
+
+def read_session(owner_id: Optional[int] = None, consistency: str = EVENTUAL) -> AsyncSession:
+    if consistency == STRONG:
+        return SessionLocal()
+    if consistency == READ_YOUR_WRITES and owner_id is not None:
+        wrote = _recent_writes.get(owner_id)
+        if wrote is not None:
+            if time.monotonic() - wrote < get_settings().read_your_writes_window_s:
+                return SessionLocal()
+            _recent_writes.pop(owner_id, None)
+    return ReadSessionLocal()
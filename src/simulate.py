@@ -0,0 +1,347 @@
+"""
+Discrete-event simulation of the job scheduler against a virtual clock.
+
+Replays process_job's scheduling policy on an in-memory queue instead of the
+database: next-run delays, FloodWait requeue and pausing, retry backoff and
+the circuit breaker for client-init failures. Telegram is replaced by a
+synthetic outcome model; its connect and RPC latencies hold a worker slot for
+a sampled stretch of virtual time, so a busy fleet queues up behind the pool
+and the pool size shows in the queue lag. A run reports per-account achieved
+rates, queue lag and the store operations the real worker would have issued
+for the same work (by type), and covers the whole fleet in seconds:
+
+    python -m src.simulate --accounts 1000 --days 30 --floodwait-p 0.02
+
+The delays themselves come from the functions process_job uses
+(m_queue._compute_delay_seconds, _retry_delay_seconds,
+_floodwait_delay_seconds, circuit._open_seconds); the state transitions
+around them are mirrored in `_Simulation._finish`, so keep it in step when
+process_job changes.
+
+Tunables (TARGET_PER_24H, SCHEDULE_JITTER_SECONDS, MAX_ATTEMPTS_PER_GROUP,
+FLOODWAIT_THRESHOLD_SECONDS_PER_24H, CIRCUIT_*, ...) are read from the
+environment as usual, so policies can be compared by changing them between
+runs.
+"""
+from __future__ import annotations
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+import argparse
+import heapq
+import json
+import math
+import random
+import time
+
+from . import circuit
+from .concurrency import AdaptiveConcurrency
+from .config import get_settings
+from .m_queue import _compute_delay_seconds, _retry_delay_seconds, _floodwait_delay_seconds
+from .utils import Clock, configure_logging, get_clock, set_clock
+
+class VirtualClock(Clock):
+    """Clock driven by the simulation; `t` is seconds since `start`."""
+
+    def __init__(self, start: datetime):
+        self.start = start
+        self.t = 0.0
+
+    def now(self) -> datetime:
+        return self.start + timedelta(seconds=self.t)
+
+    def monotonic(self) -> float:
+        return self.t
+
+@dataclass
+class OutcomeModel:
+    """
+    Synthetic Telegram: probabilities per CreateChannelRequest / client init,
+    and log-normal latencies (median seconds, shared sigma) for connect and RPC.
+    """
+    floodwait_p: float = 0.01
+    floodwait_s: tuple = (30, 900)
+    rpc_error_p: float = 0.005
+    init_error_p: float = 0.001
+    connect_latency_s: float = 0.5
+    rpc_latency_s: float = 1.5
+    latency_sigma: float = 0.5
+    rng: random.Random = field(default_factory=random.Random)
+
+    def latency(self, median_s: float) -> float:
+        if median_s <= 0:
+            return 0.0
+        return self.rng.lognormvariate(math.log(median_s), self.latency_sigma)
+
+# outcomes of one job run
+OK, FLOODWAIT, RPC_ERROR, INIT_ERROR = "ok", "floodwait", "rpc_error", "init_error"
+
+class _Account:
+    __slots__ = ("id", "active", "floodwait_s", "circuit_state", "circuit_failures", "open_until", "groups")
+
+    def __init__(self, account_id: int):
+        self.id = account_id
+        self.active = True
+        self.floodwait_s = 0
+        self.circuit_state = circuit.CLOSED
+        self.circuit_failures = 0
+        self.open_until = 0.0
+        self.groups = 0
+
+class _Job:
+    __slots__ = ("account", "attempts")
+
+    def __init__(self, account: _Account):
+        self.account = account
+        self.attempts = 0
+
+def _percentiles(values: List[float], ps=(50, 90, 99)) -> Dict[str, Optional[float]]:
+    if not values:
+        return {f"p{p}": None for p in ps}
+    vals = sorted(values)
+    return {f"p{p}": round(vals[min(len(vals) - 1, int(len(vals) * p / 100))], 1) for p in ps}
+
+class _Simulation:
+    def __init__(self, accounts: int, pool: int, pool_max: int, model: OutcomeModel, clock: VirtualClock):
+        cfg = get_settings()
+        self.cfg = cfg
+        self.model = model
+        self.clock = clock
+        self.accounts = [_Account(i + 1) for i in range(accounts)]
+        self.controller = AdaptiveConcurrency(
+            pool, pool, max(pool, pool_max),
+            rpc_latency_target_s=cfg.worker_rpc_latency_target_ms / 1000,
+            floodwait_rate_threshold=cfg.worker_floodwait_rate_threshold,
+            interval_s=cfg.worker_adjust_interval_s,
+        )
+        self._seq = 0
+        self.ready: List[Tuple[float, int, _Job]] = []  # (due, seq, job)
+        self.running: List[Tuple[float, int, _Job, str, int, float]] = []  # (finish, seq, job, outcome, floodwait_s, rpc_s)
+        self.lags: List[float] = []
+        self.ops: Counter = Counter()
+        self.notifications: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.adjustments: Counter = Counter()
+        self.limits = [pool, pool]  # min, max seen
+
+    # --- store ---------------------------------------------------------------
+
+    def _enqueue(self, job: _Job, due: float) -> None:
+        self._seq += 1
+        heapq.heappush(self.ready, (due, self._seq, job))
+
+    def _notify(self, code: str) -> None:
+        self.notifications[code] += 1
+        self.ops["event_insert"] += 1
+
+    def _schedule_next(self, account: _Account) -> None:
+        self.ops["job_insert"] += 1
+        run_at = self.clock.t + _compute_delay_seconds()
+        if account.circuit_state != circuit.CLOSED:
+            run_at = max(run_at, account.open_until)
+        self._enqueue(_Job(account), run_at)
+
+    # --- one job -------------------------------------------------------------
+
+    def _start(self, job: _Job, due: float) -> None:
+        t = self.clock.t
+        self.ops["lease"] += 1
+        self.lags.append(t - due)
+        self.controller.record_queue_lag(t - due)
+        account = job.account
+        if account.circuit_state != circuit.CLOSED:
+            # first job after the open period probes the account
+            account.circuit_state = circuit.HALF_OPEN
+            self.ops["account_update"] += 1
+        model = self.model
+        rng = model.rng
+        fw_s, rpc_s = 0, 0.0
+        busy = model.latency(model.connect_latency_s)
+        if rng.random() < model.init_error_p:
+            outcome = INIT_ERROR
+        else:
+            rpc_s = model.latency(model.rpc_latency_s)
+            busy += rpc_s
+            r = rng.random()
+            if r < model.floodwait_p:
+                outcome, fw_s = FLOODWAIT, rng.randint(*model.floodwait_s)
+            elif r < model.floodwait_p + model.rpc_error_p:
+                outcome = RPC_ERROR
+            else:
+                outcome = OK
+        self._seq += 1
+        heapq.heappush(self.running, (t + busy, self._seq, job, outcome, fw_s, rpc_s))
+
+    def _trip_circuit(self, job: _Job) -> bool:
+        """circuit.record_failure for a transient (connect) error; True if the job was put back."""
+        account = job.account
+        account.circuit_failures += 1
+        self.ops["account_update"] += 1
+        if account.circuit_state == circuit.CLOSED and account.circuit_failures < self.cfg.circuit_failure_threshold:
+            return False
+        was_closed = account.circuit_state == circuit.CLOSED
+        account.circuit_state = circuit.OPEN
+        account.open_until = self.clock.t + circuit._open_seconds(circuit.TRANSIENT, account.circuit_failures)
+        self.ops["job_update"] += 1
+        self._enqueue(job, account.open_until)
+        if was_closed:
+            self._notify("circuit_open")
+        return True
+
+    def _finish(self, job: _Job, outcome: str, fw_s: int, rpc_s: float) -> None:
+        account = job.account
+        t = self.clock.t
+        if outcome == INIT_ERROR:
+            if self._trip_circuit(job):
+                return
+            # ConnectionError is transient: retried until max attempts
+            if job.attempts + 1 < self.cfg.max_attempts_per_group:
+                job.attempts += 1
+                self.ops["job_update"] += 1
+                self._enqueue(job, t + _retry_delay_seconds(job.attempts))
+                return
+            self.ops["job_update"] += 1
+            self.statuses["failed"] += 1
+            self._notify("client_init")
+        elif outcome == OK:
+            self.controller.record_rpc(rpc_s)
+            account.groups += 1
+            self.ops["group_stat_insert"] += 1
+            self.ops["job_update"] += 1
+            self.ops["account_update"] += 1
+            self.statuses["done"] += 1
+            self._notify("group_created")
+            if account.circuit_state != circuit.CLOSED or account.circuit_failures:
+                was_closed = account.circuit_state == circuit.CLOSED
+                account.circuit_state = circuit.CLOSED
+                account.circuit_failures = 0
+                self.ops["account_update"] += 1
+                if not was_closed:
+                    self._notify("circuit_closed")
+            self._schedule_next(account)
+        elif outcome == FLOODWAIT:
+            self.controller.record_floodwait()
+            job.attempts += 1
+            self.ops["job_update"] += 1
+            account.floodwait_s += fw_s
+            self.ops["account_update"] += 1
+            self._notify("floodwait")
+            if account.floodwait_s > self.cfg.floodwait_threshold_s_24h:
+                account.active = False
+                self.ops["account_update"] += 1
+                self.ops["job_update"] += 1
+                self.statuses["paused"] += 1
+                self._notify("paused")
+            else:
+                self._enqueue(job, t + _floodwait_delay_seconds(fw_s))
+        else:
+            self.controller.record_rpc(rpc_s)
+            job.attempts += 1
+            self.ops["job_update"] += 1
+            if job.attempts >= self.cfg.max_attempts_per_group:
+                self.statuses["failed"] += 1
+            else:
+                self._enqueue(job, t + _retry_delay_seconds(job.attempts))
+            self._notify("rpc_error")
+
+    # --- event loop ------------------------------------------------------------
+
+    def run(self, end: float) -> None:
+        for account in self.accounts:
+            self._schedule_next(account)
+        self.ops.clear()
+        ready, running, controller, clock = self.ready, self.running, self.controller, self.clock
+        while True:
+            limit = controller.limit
+            while len(running) < limit and ready and ready[0][0] <= clock.t:
+                due, _, job = heapq.heappop(ready)
+                self._start(job, due)
+            if ready and ready[0][0] <= clock.t:
+                controller.record_saturated()
+            # next event: a job finishing, or (with a free slot) the next job coming due
+            nxt = running[0][0] if running else None
+            if ready and len(running) < limit and (nxt is None or ready[0][0] < nxt):
+                nxt = ready[0][0]
+            if nxt is None or nxt > end:
+                break
+            clock.t = max(clock.t, nxt)
+            while running and running[0][0] <= clock.t:
+                _, _, job, outcome, fw_s, rpc_s = heapq.heappop(running)
+                self._finish(job, outcome, fw_s, rpc_s)
+            decision = controller.maybe_adjust()
+            if decision and decision["new"] != decision["old"]:
+                self.adjustments[decision["reason"]] += 1
+                self.limits = [min(self.limits[0], decision["new"]), max(self.limits[1], decision["new"])]
+        self.statuses["queued"] += len(ready)
+        self.statuses["running"] += len(running)
+
+def run(accounts: int, days: float, pool: int, model: OutcomeModel, pool_max: int = 0) -> Dict[str, object]:
+    clock = VirtualClock(datetime(2030, 1, 1, tzinfo=timezone.utc))
+    previous_clock = get_clock()
+    set_clock(clock)
+    try:
+        sim = _Simulation(accounts, pool, pool_max, model, clock)
+        wall = time.monotonic()
+        sim.run(days * 86400)
+        wall = time.monotonic() - wall
+    finally:
+        set_clock(previous_clock)
+
+    rates = sorted(a.groups / days for a in sim.accounts)
+    return {
+        "accounts": accounts,
+        "simulated_days": days,
+        "wall_seconds": round(wall, 2),
+        "target_per_24h": sim.cfg.target_per_24h,
+        "achieved_per_24h": {
+            "mean": round(sum(rates) / len(rates), 2) if rates else None,
+            "min": round(rates[0], 2) if rates else None,
+            "max": round(rates[-1], 2) if rates else None,
+            **_percentiles(rates, (10, 50, 90)),
+        },
+        "groups_created": sum(a.groups for a in sim.accounts),
+        "accounts_paused": sum(1 for a in sim.accounts if not a.active),
+        "jobs_by_status": dict(sim.statuses),
+        "notifications": dict(sim.notifications),
+        "queue_lag_s": {**_percentiles(sim.lags), "max": round(max(sim.lags), 1) if sim.lags else None},
+        "pool": {
+            "final": sim.controller.limit,
+            "min": sim.limits[0],
+            "max": sim.limits[1],
+            "adjustments": dict(sim.adjustments),
+        },
+        "store_ops": dict(sim.ops),
+        "store_ops_total": sum(sim.ops.values()),
+    }
+
+def main(argv: Optional[List[str]] = None) -> None:
+    p = argparse.ArgumentParser(description="Simulate the job scheduler against a virtual clock.")
+    p.add_argument("--accounts", type=int, default=100)
+    p.add_argument("--days", type=float, default=30)
+    p.add_argument("--pool", type=int, default=4)
+    p.add_argument("--pool-max", type=int, default=0, help="let the AIMD controller grow the pool up to this (default: fixed pool)")
+    p.add_argument("--floodwait-p", type=float, default=0.01)
+    p.add_argument("--rpc-error-p", type=float, default=0.005)
+    p.add_argument("--init-error-p", type=float, default=0.001)
+    p.add_argument("--connect-latency", type=float, default=0.5, help="median seconds")
+    p.add_argument("--rpc-latency", type=float, default=1.5, help="median seconds")
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args(argv)
+
+    configure_logging(level="warning")
+    # jitter/delays use the global RNG
+    random.seed(args.seed)
+    model = OutcomeModel(
+        floodwait_p=args.floodwait_p,
+        rpc_error_p=args.rpc_error_p,
+        init_error_p=args.init_error_p,
+        connect_latency_s=args.connect_latency,
+        rpc_latency_s=args.rpc_latency,
+        rng=random.Random(args.seed),
+    )
+    report = run(args.accounts, args.days, args.pool, model, args.pool_max)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,269 @@
-import os
+import sys
+import asyncio
+import time
+import queue
+import atexit
+import logging
 import random
+import threading
 import structlog
 from datetime import datetime, timezone, timedelta
-from typing import List
-from dotenv import load_dotenv
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+logger = structlog.get_logger()
 
-load_dotenv()
+# --- logging pipeline --------------------------------------------------------
+# structlog renders JSON on the calling thread (cheap), then hands the line to
+# a bounded queue drained by a daemon thread. The event loop never blocks on
+# stdout/journald: when the queue is filling up info/debug lines are sampled,
+# and when it is full lines are dropped and counted.
 
-logger = structlog.get_logger()
+_LEVELS = {"debug": 10, "info": 20, "warning": 30, "warn": 30, "error": 40, "exception": 40, "critical": 50}
+
+class _LogSink:
+    def __init__(self, stream: TextIO, maxsize: int = 10000, sample_every: int = 10, report_every_s: float = 10.0):
+        self.stream = stream
+        self.q: "queue.Queue[Optional[str]]" = queue.Queue(maxsize=max(1, maxsize))
+        self.high_watermark = max(1, int(maxsize * 0.8))
+        self.sample_every = max(1, sample_every)
+        self.report_every_s = report_every_s
+        self._lock = threading.Lock()
+        self._dropped = 0
+        self._sampled = 0
+        self._seen_under_pressure = 0
+        self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+        self._thread.start()
+
+    def submit(self, level: int, line: str) -> None:
+        if level < logging.WARNING and self.q.qsize() >= self.high_watermark:
+            with self._lock:
+                self._seen_under_pressure += 1
+                keep = self._seen_under_pressure % self.sample_every == 0
+                if not keep:
+                    self._sampled += 1
+                    return
+        try:
+            self.q.put_nowait(line)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def _take_counters(self) -> Tuple[int, int]:
+        with self._lock:
+            d, s = self._dropped, self._sampled
+            self._dropped = self._sampled = 0
+        return d, s
+
+    def _run(self) -> None:
+        last_report = time.monotonic()
+        while True:
+            line = self.q.get()
+            batch = [line]
+            # write whatever is already queued in one go
+            while len(batch) < 256:
+                try:
+                    batch.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                for item in batch:
+                    if item is not None:
+                        self.stream.write(item + "\n")
+                if time.monotonic() - last_report >= self.report_every_s or stop:
+                    last_report = time.monotonic()
+                    dropped, sampled = self._take_counters()
+                    if dropped or sampled:
+                        self.stream.write(
+                            structlog.processors.JSONRenderer()(None, "", {
+                                "event": "log.dropped", "level": "warning",
+                                "dropped": dropped, "sampled_out": sampled,
+                                "timestamp": now_utc().isoformat().replace("+00:00", "Z"),
+                            }) + "\n"
+                        )
+                self.stream.flush()
+            except Exception:
+                pass
+            for _ in batch:
+                self.q.task_done()
+            if stop:
+                return
+
+    def close(self, timeout_s: float = 2.0) -> None:
+        try:
+            self.q.put(None, timeout=timeout_s)
+        except queue.Full:
+            return
+        self._thread.join(timeout_s)
+
+class _QueueLogger:
+    """Minimal structlog logger: every level method hands the rendered line to the sink."""
+    def __init__(self, *args: Any):
+        pass
+
+    def _emit(self, level: int, message: str) -> None:
+        sink = _sink
+        if sink is None:
+            # after shutdown_logging(): write synchronously
+            sys.stdout.write(message + "\n")
+            return
+        sink.submit(level, message)
+
+    def debug(self, message: str) -> None: self._emit(10, message)
+    def info(self, message: str) -> None: self._emit(20, message)
+    def msg(self, message: str) -> None: self._emit(20, message)
+    def warning(self, message: str) -> None: self._emit(30, message)
+    warn = warning
+    def error(self, message: str) -> None: self._emit(40, message)
+    exception = error
+    def critical(self, message: str) -> None: self._emit(50, message)
+    fatal = critical
+
+class _RateLimiter:
+    """
+    Token bucket per event name. Events over budget are dropped; the next
+    line that gets through carries `suppressed=<n>`. Errors always pass.
+    """
+    def __init__(self, per_s: float, burst: int):
+        self.per_s = per_s
+        self.burst = max(1, burst)
+        self._buckets: Dict[str, List[float]] = {}  # event -> [tokens, last_ts, suppressed]
+
+    def __call__(self, _logger: Any, method_name: str, event_dict: Dict[str, Any]) -> Dict[str, Any]:
+        if self.per_s <= 0 or _LEVELS.get(method_name, 20) >= logging.ERROR:
+            return event_dict
+        name = str(event_dict.get("event", ""))
+        now = time.monotonic()
+        b = self._buckets.get(name)
+        if b is None:
+            b = self._buckets[name] = [float(self.burst), now, 0]
+        b[0] = min(float(self.burst), b[0] + (now - b[1]) * self.per_s)
+        b[1] = now
+        if b[0] < 1.0:
+            b[2] += 1
+            raise structlog.DropEvent
+        b[0] -= 1.0
+        if b[2]:
+            event_dict["suppressed"] = int(b[2])
+            b[2] = 0
+        return event_dict
+
+class _LevelFilter:
+    """Drops events below `level`; a processor (not the wrapper class) so reloads reach cached loggers."""
+    def __init__(self, level: int):
+        self.level = level
+
+    def __call__(self, _logger: Any, method_name: str, event_dict: Dict[str, Any]) -> Dict[str, Any]:
+        if _LEVELS.get(method_name, logging.INFO) < self.level:
+            raise structlog.DropEvent
+        return event_dict
+
+_sink: Optional[_LogSink] = None
+_level_filter = _LevelFilter(logging.INFO)
+_rate_limiter = _RateLimiter(0, 1)
+_reload_registered = False
+
+def configure_logging(
+    level: Optional[str] = None,
+    queue_size: Optional[int] = None,
+    rate_per_event_s: Optional[float] = None,
+    burst_per_event: Optional[int] = None,
+    stream: Optional[TextIO] = None,
+) -> None:
+    """
+    Route structlog through the JSON renderer and the background sink.
+    Call once at process start, before the first log line. The LOG_*
+    settings are re-applied on a settings reload (SIGHUP).
+    """
+    from .config import get_settings, on_reload
+    global _sink, _level_filter, _rate_limiter, _reload_registered
+    cfg = get_settings()
+    level = (level or cfg.log_level).lower()
+    queue_size = queue_size if queue_size is not None else cfg.log_queue_size
+    rate = rate_per_event_s if rate_per_event_s is not None else cfg.log_rate_per_event_per_second
+    burst = burst_per_event if burst_per_event is not None else cfg.log_burst_per_event
+
+    if _sink is not None:
+        _sink.close()
+    _sink = _LogSink(stream or sys.stdout, maxsize=queue_size)
+    _level_filter = _LevelFilter(_LEVELS.get(level, logging.INFO))
+    _rate_limiter = _RateLimiter(rate, burst)
+    structlog.configure(
+        processors=[
+            _level_filter,
+            structlog.contextvars.merge_contextvars,
+            structlog.processors.add_log_level,
+            _rate_limiter,
+            structlog.processors.TimeStamper(fmt="iso", utc=True),
+            structlog.processors.format_exc_info,
+            structlog.processors.JSONRenderer(ensure_ascii=False),
+        ],
+        wrapper_class=structlog.make_filtering_bound_logger(logging.DEBUG),
+        logger_factory=_QueueLogger,
+        cache_logger_on_first_use=True,
+    )
+    if not _reload_registered:
+        on_reload(reconfigure_logging)
+        _reload_registered = True
+
+def reconfigure_logging(cfg: Any) -> None:
+    """Apply LOG_LEVEL, LOG_QUEUE_SIZE and the rate limits to the running pipeline."""
+    global _sink
+    _level_filter.level = _LEVELS.get(cfg.log_level.lower(), logging.INFO)
+    _rate_limiter.per_s = cfg.log_rate_per_event_per_second
+    _rate_limiter.burst = max(1, cfg.log_burst_per_event)
+    old = _sink
+    if old is not None and old.q.maxsize != max(1, cfg.log_queue_size):
+        # loggers look the sink up per line, so swapping it is enough; the old one drains first
+        _sink = _LogSink(old.stream, maxsize=cfg.log_queue_size)
+        old.close()
+
+def shutdown_logging() -> None:
+    """Flush queued log lines (registered with atexit)."""
+    global _sink
+    if _sink is not None:
+        _sink.close()
+        _sink = None
+
+atexit.register(shutdown_logging)
+
+# --- clock -------------------------------------------------------------------
+# Scheduling code reads time and idles through the active clock so the
+# simulator (src/simulate.py) can swap in a virtual one.
+
+class Clock:
+    def now(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    async def wait(self, event: asyncio.Event, timeout: float) -> None:
+        """Sleep up to `timeout` seconds, returning early once `event` is set."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+_clock: Clock = Clock()
+
+def get_clock() -> Clock:
+    return _clock
+
+def set_clock(clock: Clock) -> None:
+    global _clock
+    _clock = clock
 
 def now_utc() -> datetime:
-    return datetime.now(timezone.utc)
+    return _clock.now()
+
+def monotonic() -> float:
+    return _clock.monotonic()
+
+def as_utc(dt: datetime) -> datetime:
+    # SQLite hands back naive datetimes; treat them as UTC
+    if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
 
 def jitter(seconds: int = 30) -> int:
     return random.randint(0, max(1, seconds))
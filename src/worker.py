@@ -1,35 +1,66 @@
 import asyncio
-import os
-from sqlalchemy import text
-from .models import Base, engine, SessionLocal, Account, Job
-from .m_queue import worker_loop, schedule_next_for_account
-from .utils import logger
+import signal
+from sqlalchemy import text, bindparam, DateTime
+from .models import get_engine, SessionLocal, Account, Job
+from .migrations import run_migrations
+from .m_queue import worker_loop, schedule_next_for_account, reclaim_stale_jobs
+from .concurrency import AdaptiveConcurrency
+from .utils import logger, configure_logging, now_utc
+from .config import get_settings, on_reload, install_reload_handler
+
+BOOTSTRAP_SQL = """
+    SELECT accounts.id FROM accounts
+    WHERE accounts.is_active = 1
+      AND (accounts.circuit_state = 'closed' OR accounts.circuit_open_until <= :now)
+      AND NOT EXISTS (
+        SELECT 1 FROM jobs
+        WHERE jobs.account_id = accounts.id AND jobs.status IN ('queued','running')
+      )
+"""
+
+def bootstrap_query(now):
+    return text(BOOTSTRAP_SQL).bindparams(bindparam("now", now, type_=DateTime(timezone=True)))
 
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    await run_migrations(get_engine())
 
 async def bootstrap_targets():
-    # ensure each active account has at least one queued job
+    # ensure each active account has at least one queued job (open circuits keep theirs for the probe)
     async with SessionLocal() as s:
-        res = await s.execute(text("""
-            SELECT accounts.id FROM accounts
-            LEFT JOIN jobs ON jobs.account_id = accounts.id AND jobs.status IN ('queued','running')
-            WHERE accounts.is_active = 1
-            GROUP BY accounts.id
-            HAVING COUNT(jobs.id) = 0
-        """))
+        res = await s.execute(bootstrap_query(now_utc()))
         for (acc_id,) in res.fetchall():
             acc = await s.get(Account, acc_id)
             await schedule_next_for_account(s, acc)
 
+def install_signal_handlers(stop: asyncio.Event) -> None:
+    # SIGTERM (systemd stop/restart) and SIGINT stop leasing and drain in-flight jobs
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
 async def main():
+    configure_logging()
     await init_db()
+    # jobs left `running` by a crashed worker would otherwise block their accounts forever
+    async with SessionLocal() as s:
+        await reclaim_stale_jobs(s)
     await bootstrap_targets()
-    pool = int(os.getenv("CONCURRENT_WORKERS_PER_ACCOUNT", "1"))  # we reuse as pool size
-    logger.info("worker.start", pool=pool)
+    cfg = get_settings()
+    pool = cfg.concurrent_workers_per_account  # we reuse as initial pool size
+    # bounds at construction, or `initial` is clamped to the default max first
+    controller = AdaptiveConcurrency(initial=pool, min_limit=cfg.worker_pool_min, max_limit=cfg.pool_max)
+    controller.reconfigure(cfg)
+    # SIGHUP: re-read tunables; delays/targets apply to the next job, pool bounds right away
+    on_reload(controller.reconfigure)
+    install_reload_handler()
+    logger.info("worker.start", pool=controller.limit, pool_min=controller.min_limit, pool_max=controller.max_limit)
     stop = asyncio.Event()
-    await worker_loop(pool, stop)
+    install_signal_handlers(stop)
+    await worker_loop(pool, stop, controller)
+    logger.info("worker.stopped")
 
 if __name__ == "__main__":
     asyncio.run(main())
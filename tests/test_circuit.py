@@ -0,0 +1,223 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from telethon.errors import AuthKeyUnregisteredError, RPCError, ServerError
+
+from src import circuit
+from src.accounts import enable_accounts
+from src.config import get_settings
+from src.m_queue import ready_jobs_query
+from src.migrations import run_migrations
+from src.models import Account, Job, User
+from src.utils import Clock, as_utc, get_clock, set_clock
+
+
+class _ManualClock(Clock):
+    def __init__(self):
+        self.t = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+    def now(self):
+        return self.t
+
+    def monotonic(self):
+        return self.t.timestamp()
+
+    def advance(self, seconds):
+        self.t += timedelta(seconds=seconds)
+
+
+@pytest.fixture
+def clock():
+    previous = get_clock()
+    c = _ManualClock()
+    set_clock(c)
+    yield c
+    set_clock(previous)
+
+
+def _with_account(tmp_path, clock, scenario, jobs=1):
+    """Run `scenario(sessionmaker, account_id, job_ids)` on a fresh database with one account."""
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'circuit.db'}")
+        try:
+            await run_migrations(engine)
+            sm = async_sessionmaker(engine, expire_on_commit=False)
+            async with sm() as s:
+                s.add(User(id=1))
+                await s.flush()
+                acc = Account(owner_id=1, api_id="1", api_hash_enc=b"", phone="+1", session_enc=b"")
+                s.add(acc)
+                await s.flush()
+                queued = [Job(account_id=acc.id, next_run_at=clock.now()) for _ in range(jobs)]
+                s.add_all(queued)
+                await s.commit()
+            return await scenario(sm, acc.id, [j.id for j in queued])
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(_run())
+
+
+async def _fail(sm, account_id, job_id, kind):
+    async with sm() as s:
+        acc = await s.get(Account, account_id)
+        job = await s.get(Job, job_id)
+        return await circuit.record_failure(s, job, acc, kind, "boom")
+
+
+async def _load(sm, account_id, job_id=None):
+    async with sm() as s:
+        acc = await s.get(Account, account_id)
+        job = await s.get(Job, job_id) if job_id else None
+        return acc, job
+
+
+def _open_s(clock, until):
+    return (as_utc(until) - clock.now()).total_seconds()
+
+
+def test_classify():
+    assert circuit.classify(AuthKeyUnregisteredError(None)) == circuit.AUTH
+    assert circuit.classify(ServerError(None, "INTERNAL")) == circuit.TRANSIENT
+    assert circuit.classify(ConnectionError("reset")) == circuit.TRANSIENT
+    assert circuit.classify(RPCError(None, "CHAT_TITLE_EMPTY", 400)) is None
+    # a ValueError only means broken credentials while building the client
+    assert circuit.classify(ValueError("bad session"), client_init=True) == circuit.AUTH
+    assert circuit.classify(ValueError("bad request")) is None
+
+
+def test_auth_failure_opens_at_once_and_holds_queued_jobs(tmp_path, clock):
+    cfg = get_settings()
+
+    async def scenario(sm, account_id, job_ids):
+        until = await _fail(sm, account_id, job_ids[0], circuit.AUTH)
+        acc, job = await _load(sm, account_id, job_ids[0])
+        _, other = await _load(sm, account_id, job_ids[1])
+        return until, acc, job, other
+
+    until, acc, job, other = _with_account(tmp_path, clock, scenario, jobs=2)
+    base = cfg.circuit_auth_open_base_s
+    assert base <= _open_s(clock, until) <= base * 1.1
+    assert (acc.circuit_state, acc.circuit_failures) == (circuit.OPEN, 1)
+    assert as_utc(acc.circuit_open_until) == until
+    for j in (job, other):
+        assert (j.status, as_utc(j.next_run_at), j.circuit_hold) == ("queued", until, True)
+    assert job.error.startswith("circuit open:")
+
+
+def test_transient_failures_open_at_threshold(tmp_path, clock):
+    cfg = get_settings()
+
+    async def scenario(sm, account_id, job_ids):
+        below = [await _fail(sm, account_id, job_ids[0], circuit.TRANSIENT)
+                 for _ in range(cfg.circuit_failure_threshold - 1)]
+        closed, _ = await _load(sm, account_id)
+        until = await _fail(sm, account_id, job_ids[0], circuit.TRANSIENT)
+        opened, _ = await _load(sm, account_id)
+        return below, closed, until, opened
+
+    below, closed, until, opened = _with_account(tmp_path, clock, scenario)
+    assert below == [None] * (cfg.circuit_failure_threshold - 1)
+    assert closed.circuit_state == circuit.CLOSED
+    assert cfg.circuit_open_base_s <= _open_s(clock, until) <= cfg.circuit_open_base_s * 1.1
+    assert (opened.circuit_state, opened.circuit_failures) == (circuit.OPEN, cfg.circuit_failure_threshold)
+
+
+def test_open_account_is_skipped_by_the_lease_query(tmp_path, clock):
+    async def scenario(sm, account_id, job_ids):
+        until = await _fail(sm, account_id, job_ids[0], circuit.AUTH)
+        async with sm() as s:
+            # a job due now for the blocked account (e.g. enqueued by hand)
+            s.add(Job(account_id=account_id, next_run_at=clock.now()))
+            await s.commit()
+            blocked = (await s.execute(ready_jobs_query(clock.now()))).scalar_one_or_none()
+            clock.t = until
+            due = (await s.execute(ready_jobs_query(clock.now()))).scalars().all()
+        return blocked, due
+
+    blocked, due = _with_account(tmp_path, clock, scenario)
+    assert blocked is None
+    assert len(due) == 1
+
+
+def test_half_open_probe_is_claimed_once_and_leased(tmp_path, clock):
+    lease_s = get_settings().job_lease_s
+
+    async def scenario(sm, account_id, job_ids):
+        until = await _fail(sm, account_id, job_ids[0], circuit.AUTH)
+        clock.t = as_utc(until)
+        async with sm() as s1, sm() as s2:
+            acc1, job1 = await s1.get(Account, account_id), await s1.get(Job, job_ids[0])
+            # the second worker read the account before the first one claimed the probe
+            acc2, job2 = await s2.get(Account, account_id), await s2.get(Job, job_ids[1])
+            first = await circuit.admit(s1, job1, acc1)
+            second = await circuit.admit(s2, job2, acc2)
+            probing = (acc1.circuit_state, as_utc(acc1.circuit_open_until))
+            skipped = (job2.status, as_utc(job2.next_run_at), job2.circuit_hold)
+            # the probing worker dies: once its lease runs out another job may probe
+            clock.advance(lease_s)
+            retaken = await circuit.admit(s2, job2, acc2)
+        return first, second, probing, skipped, retaken
+
+    first, second, probing, skipped, retaken = _with_account(tmp_path, clock, scenario, jobs=2)
+    lease_end = clock.t
+    assert first is True and second is False
+    assert probing == (circuit.HALF_OPEN, lease_end)
+    assert skipped == ("queued", lease_end, True)
+    assert retaken is True
+
+
+def test_failed_probes_double_the_open_period(tmp_path, clock):
+    cfg = get_settings()
+
+    async def scenario(sm, account_id, job_ids):
+        periods = []
+        for _ in range(3):
+            until = await _fail(sm, account_id, job_ids[0], circuit.AUTH)
+            periods.append(_open_s(clock, until))
+            clock.t = as_utc(until)
+            async with sm() as s:
+                acc, job = await s.get(Account, account_id), await s.get(Job, job_ids[0])
+                assert await circuit.admit(s, job, acc)
+        return periods
+
+    periods = _with_account(tmp_path, clock, scenario)
+    base = cfg.circuit_auth_open_base_s
+    for n, period in enumerate(periods):
+        expected = min(cfg.circuit_open_max_s, base * 2 ** n)
+        assert expected <= period <= expected * 1.1
+
+
+def test_open_period_is_capped():
+    cfg = get_settings()
+    assert circuit._open_seconds(circuit.AUTH, 40) <= cfg.circuit_open_max_s * 1.1
+    assert circuit._open_seconds(circuit.TRANSIENT, 40) <= cfg.circuit_open_max_s * 1.1
+
+
+def test_success_closes_the_circuit(tmp_path, clock):
+    async def scenario(sm, account_id, job_ids):
+        await _fail(sm, account_id, job_ids[0], circuit.AUTH)
+        async with sm() as s:
+            acc = await s.get(Account, account_id)
+            first = await circuit.record_success(s, acc)
+            again = await circuit.record_success(s, acc)
+        acc, _ = await _load(sm, account_id)
+        return first, again, acc
+
+    first, again, acc = _with_account(tmp_path, clock, scenario)
+    assert (first, again) == (True, False)
+    assert (acc.circuit_state, acc.circuit_failures, acc.circuit_open_until) == (circuit.CLOSED, 0, None)
+
+
+def test_enable_resets_the_breaker_and_releases_held_jobs(tmp_path, clock):
+    async def scenario(sm, account_id, job_ids):
+        await _fail(sm, account_id, job_ids[0], circuit.AUTH)
+        async with sm() as s:
+            await enable_accounts(s, [account_id])
+        return await _load(sm, account_id, job_ids[0])
+
+    acc, job = _with_account(tmp_path, clock, scenario)
+    assert (acc.circuit_state, acc.circuit_failures, acc.circuit_open_until) == (circuit.CLOSED, 0, None)
+    assert (job.status, as_utc(job.next_run_at), job.circuit_hold) == ("queued", clock.now(), False)
@@ -0,0 +1,54 @@
+import asyncio
+from datetime import timedelta
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.migrations import MIGRATIONS, check_query_plans, run_migrations
+from src.models import Account, EventLog, GroupStat, Job, User
+from src.utils import now_utc
+
+
+async def _plan_offenders(db_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    try:
+        applied = await run_migrations(engine)
+        assert applied == [v for v, _, _ in MIGRATIONS]
+
+        now = now_utc()
+        async with async_sessionmaker(engine)() as s:
+            s.add_all([User(id=1), User(id=2)])
+            await s.flush()
+            accounts = [
+                Account(owner_id=1 + i % 2, api_id="1", api_hash_enc=b"", phone=f"+{i}", session_enc=b"", is_active=i % 3 != 0)
+                for i in range(6)
+            ]
+            s.add_all(accounts)
+            await s.flush()
+            for i, acc in enumerate(accounts):
+                s.add_all([
+                    Job(account_id=acc.id, status=("queued", "running", "done", "failed")[i % 4], next_run_at=now + timedelta(minutes=i)),
+                    GroupStat(account_id=acc.id, created_at=now - timedelta(hours=i)),
+                    EventLog(owner_id=acc.owner_id, account_id=acc.id, code="group_created", message="x"),
+                ])
+            await s.commit()
+
+        async with engine.connect() as conn:
+            return await conn.run_sync(check_query_plans)
+    finally:
+        await engine.dispose()
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    assert asyncio.run(_plan_offenders(tmp_path / "plans.db")) == {}
+
+
+def test_migrations_are_idempotent(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'twice.db'}")
+        try:
+            await run_migrations(engine)
+            return await run_migrations(engine)
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(_run()) == []